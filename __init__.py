@@ -1,35 +1,49 @@
-import relish
 import logging
-import requests
-import requests_cache
 import sys,os,glob,time
-import pandas as pd
-import importlib.resources as pkg_resources
 from . import data as league_data
-from .tools import League,Player,Team,posrank_split,players_df_to_players
-from nfldata import data as sharpe_data
-from .matcher import fuzzy_get_df
-from .pfr_tools import check_position_mascot
-from .scraper import get_soup,get_pfr_id_from_google
+from .tools import League,Player,PlayerTable,Team,posrank_split,players_df_to_players
 import re
-import numpy as np
+import json
+from concurrent.futures import ThreadPoolExecutor,as_completed
 from .pfr_id_explicit import dictionary as pfr_id_dict
 from .entry_years import dictionary as entry_years_dictionary
 
-logging.basicConfig(filename='fantasy_tools.log', level=logging.INFO)
-logging.getLogger().addHandler(logging.StreamHandler())
-
-with pkg_resources.open_text(league_data, 'nfl_teams.csv') as fid:
-    teams_df = pd.read_csv(fid)
-        
-with pkg_resources.open_text(league_data, 'owners.csv') as fid:
-    owners_df = pd.read_csv(fid)
-
-with pkg_resources.open_text(sharpe_data, 'pff_pfr_map_v1.csv') as fid:
-    player_name_df = pd.read_csv(fid)
-
-with pkg_resources.open_text(sharpe_data, 'draft_picks.csv') as fid:
-    draft_df = pd.read_csv(fid)
+# Importing the package is kept cheap: pandas, requests, relish, the scraping
+# modules and Sharpe's nfldata tables are only imported or read when a function
+# that needs them is first called. See import_benchmark.py for the import time.
+
+logging_configured = False
+
+def setup_logging(filename='fantasy_tools.log',level=logging.INFO):
+    # log to filename and the console; called by the build functions, once
+    global logging_configured
+    if not logging_configured:
+        logging.basicConfig(filename=filename,level=level)
+        logging.getLogger().addHandler(logging.StreamHandler())
+        logging_configured = True
+
+# name: (package,filename) of the data tables, read on first use with get_data
+# or as attributes of the package, e.g. fantasy_tools.teams_df
+data_files = {'teams_df':(league_data,'nfl_teams.csv'),
+              'owners_df':(league_data,'owners.csv'),
+              'player_name_df':('nfldata.data','pff_pfr_map_v1.csv'),
+              'draft_df':('nfldata.data','draft_picks.csv')}
+
+data_tables = {}
+
+def get_data(name):
+    if not name in data_tables:
+        import pandas as pd
+        import importlib.resources as pkg_resources
+        package,filename = data_files[name]
+        with pkg_resources.open_text(package,filename) as fid:
+            data_tables[name] = pd.read_csv(fid)
+    return data_tables[name]
+
+def __getattr__(name):
+    if name in data_files:
+        return get_data(name)
+    raise AttributeError("module %r has no attribute %r"%(__name__,name))
 
 # For the next dataset, we need to download ECR table from FP:
 # 1. Go to the URL https://www.fantasypros.com/nfl/rankings/half-point-ppr-cheatsheets.php
@@ -53,7 +67,7 @@ def poll_list0(L):
         assert not all([c==1 for c in counts])
     except AssertionError:
         raise MultipleWinnerException
-    return L[np.argmax(counts)]
+    return L[counts.index(max(counts))]
         
 def poll_list(L):
     counts = {}
@@ -66,7 +80,7 @@ def poll_list(L):
     print(counts)
     keys = [k for k in counts.keys()]
     vals = [counts[k] for k in keys]
-    max_count = np.max(vals)
+    max_count = max(vals)
     print(max_count)
     winners = []
     for idx,val in enumerate(vals):
@@ -83,7 +97,306 @@ def get_id(name,position,team):
     out = name.lower().strip()+position.lower().strip()+team.lower().strip()
     return out
 
-def build_player_table_initial(rankings_file):
+known_pfr_id_prefixes = None
+
+def known_pfr_ids():
+    # {pfr_id prefix (e.g. 'AlleJo'): {suffix number: set of player names}} for
+    # every pfr_id in Sharpe's pff_pfr_map and draft_picks tables; built once
+    global known_pfr_id_prefixes
+    if known_pfr_id_prefixes is None:
+        prefixes = {}
+        for df,name_col in [(get_data('player_name_df'),'pff_name'),(get_data('draft_df'),'pfr_name')]:
+            for pfr_id,name in zip(df['pfr_id'].tolist(),df[name_col].tolist()):
+                if not (type(pfr_id)==str and len(pfr_id)>2 and pfr_id[-2:].isdigit()):
+                    continue
+                names = prefixes.setdefault(pfr_id[:-2],{}).setdefault(int(pfr_id[-2:]),set())
+                if type(name)==str:
+                    names.add(name)
+        known_pfr_id_prefixes = prefixes
+    return known_pfr_id_prefixes
+
+def pfr_id_guesses(fp_name,known_prefixes,max_suffix=10):
+    # Candidate pfr_ids for a player, most likely first. PFR ids are the first four
+    # letters of the last name, the first two of the first name and a two digit
+    # number that increments with each new player sharing the prefix. Ids that
+    # Sharpe's tables attribute to someone else are never guessed; ids attributed
+    # to this player's name (the same once punctuation and Jr., III etc. are
+    # removed) come first, then the next unused number for each likely
+    # (first,last) pair of name parts, then the remaining unused numbers.
+    from .matcher import normalize_name
+    generational = ['jr','jr.','sr','sr.','ii','iii','iv','v']
+
+    def plain_name(name):
+        return ' '.join([a for a in normalize_name(name).split() if not a in generational])
+
+    my_name = plain_name(fp_name)
+
+    def fix(s):
+        out = []
+        for a in s:
+            test = a.replace("'",'').replace(',','').replace('-','')
+            if a==test:
+                out.append(a)
+            else:
+                out = out + [a,test]
+        return out
+
+    # PFR ignores Jr., III and the like
+    name_parts = [a for a in fp_name.split() if not a.lower().strip(',') in generational]
+    variants = set()
+    for a in name_parts:
+        test = a.replace("'",'').replace(',','').replace('-','')
+        if not a==test:
+            variants.add((a,test))
+    name_parts = fix(name_parts)
+
+    pairs = []
+    n_parts = len(name_parts)
+    for k1 in range(n_parts):
+        for k2 in range(k1+1,n_parts):
+            first,last = name_parts[k1],name_parts[k2]
+            if (first,last) in variants:
+                continue
+            # prefer the first name with the last real surname
+            likelihood = (k1>0,n_parts-1-k2)
+            pairs.append((likelihood,first,last))
+    pairs.sort(key=lambda item: item[0])
+
+    first_tier = []
+    second_tier = []
+    for likelihood,first,last in pairs:
+        prefix = last[:4]+first[:2]
+        known = known_prefixes.get(prefix,{})
+        mine = []
+        others = []
+        for suffix in sorted(known.keys()):
+            if any([plain_name(name)==my_name for name in known[suffix]]):
+                mine.append(suffix)
+            else:
+                others.append(suffix)
+        unused = [n for n in range(max_suffix) if not n in known]
+        if len(known):
+            next_unused = [n for n in unused if n>max(known.keys())]
+        else:
+            next_unused = unused
+        first_tier+=['%s%02d'%(prefix,n) for n in mine+next_unused[:1]]
+        second_tier+=['%s%02d'%(prefix,n) for n in unused if not n in next_unused[:1]]
+
+    out = []
+    for guess in first_tier+second_tier:
+        if not guess in out:
+            out.append(guess)
+    return out
+
+def resolve_pfr_id(fp_name,position,mascot,player_name_sub_df,draft_sub_df,verbose=True,return_method=False):
+    # Work out the pfr_id of one player: poll candidates from Google and Sharpe's tables,
+    # check them against the player's PFR page, brute force likely ids if none check out,
+    # and finally defer to pfr_id_explicit. Returns '' if nothing is found. With
+    # return_method, returns (pfr_id,method), method being 'polled', 'brute_force',
+    # 'explicit' or 'unresolved'.
+    from .pfr_tools import check_position_mascot
+    from .scraper import get_pfr_id_from_google
+    if verbose:
+        print('Determining pfr_id for player %s.'%fp_name)
+
+    pfr_id = ''
+    method = 'unresolved'
+    pfr_id_candidates = []
+    try:
+        pfr_id_candidates.append(get_pfr_id_from_google(fp_name))
+    except:
+        pass
+
+    if len(player_name_sub_df)>=1:
+        pfr_id_candidates+=player_name_sub_df['pfr_id'].values.tolist()
+
+    if len(draft_sub_df)>=1:
+        pfr_id_candidates+=draft_sub_df['pfr_id'].values.tolist()
+
+    if verbose:
+        print('candidates from google, player_name_sub_df, draft_sub_df:')
+        print('\t',pfr_id_candidates)
+
+    pfr_id_candidates = [p for p in pfr_id_candidates if type(p)==str]
+    pfr_id_candidates = [p for p in pfr_id_candidates if len(p)>4]
+
+    if len(pfr_id_candidates)>0:
+        if verbose:
+            print('candidates after cleanup')
+            print(pfr_id_candidates)
+
+        winners = poll_list(pfr_id_candidates)
+        if verbose:
+            print('candidates after polling')
+            print(winners)
+
+        for w in winners:
+            if check_position_mascot(w,position,mascot):
+                pfr_id = w
+                method = 'polled'
+                break
+
+        if verbose:
+            print('winning candidate for %s is %s'%(fp_name,pfr_id))
+
+        if pfr_id=='':
+            if verbose:
+                print('winning candidate was empty string')
+
+            for testn in pfr_id_guesses(fp_name,known_pfr_ids()):
+                if verbose:
+                    print('Brute force checking %s.'%testn)
+                if check_position_mascot(testn,position,mascot,verbose=True):
+                    print('%s checks out. Using it unless dictionary specifies otherwise.'%testn)
+                    pfr_id = testn
+                    method = 'brute_force'
+                    break
+
+    # last, last ditch:
+    try:
+        pfr_id = pfr_id_dict[fp_name]
+        method = 'explicit'
+        if verbose:
+            print('%s specified in dictionary. Using it.'%pfr_id)
+    except:
+        pass
+
+    if pfr_id=='':
+        print(fp_name,'no pfr_id')
+    if return_method:
+        return pfr_id,method
+    return pfr_id
+
+def resolve_pfr_ids(jobs,workers=8,on_result=None):
+    # Resolve many players at once. jobs maps a relish tag to the arguments of
+    # resolve_pfr_id; each result is relished as soon as it's found and all are
+    # returned in a dictionary keyed by tag. The requests made by the workers are
+    # spaced by the per-host rate limiters in scraper, so a cold build takes about
+    # as long as the rate limits allow rather than the sum of the round trips.
+    # on_result(tag,pfr_id,method) is called, in this thread, as each one finishes.
+    import relish
+    out = {}
+    if len(jobs)==0:
+        return out
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for tag,args in jobs.items():
+            futures[executor.submit(resolve_pfr_id,*args,return_method=True)] = tag
+        for future in as_completed(futures):
+            tag = futures[future]
+            try:
+                pfr_id,method = future.result()
+            except Exception as e:
+                # leave it uncached so it's retried on the next build
+                logging.error('Could not resolve pfr_id for %s: %s'%(tag,e))
+                out[tag] = ''
+                continue
+            relish.save(tag,pfr_id)
+            out[tag] = pfr_id
+            if on_result is not None:
+                on_result(tag,pfr_id,method)
+    return out
+
+class BuildJournal:
+    # Append-only log of the players finished by a long build, one JSON record per
+    # line, each flushed to disk as it's written, so that a build interrupted
+    # partway can be rerun and skip them. records maps key to the latest record; a
+    # line cut short by a crash is ignored.
+
+    def __init__(self,filename,key='unique_id'):
+        self.filename = filename
+        self.key = key
+        self.records = {}
+        try:
+            with open(filename,'r') as fid:
+                for line in fid:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record[key]] = record
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self,key):
+        return key in self.records
+
+    def append(self,record):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)),exist_ok=True)
+        with open(self.filename,'a') as fid:
+            fid.write(json.dumps(record)+'\n')
+            fid.flush()
+            os.fsync(fid.fileno())
+        self.records[record[self.key]] = record
+
+    def extend(self,records):
+        # append many records with a single flush
+        if len(records)==0:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)),exist_ok=True)
+        with open(self.filename,'a') as fid:
+            for record in records:
+                fid.write(json.dumps(record)+'\n')
+            fid.flush()
+            os.fsync(fid.fileno())
+        for record in records:
+            self.records[record[self.key]] = record
+
+def attach_draft_info(player_df,draft_df,rookie_year=None):
+    # Copy of player_df with draft_year, draft_round and draft_pick columns. Rows
+    # with a pfr_id get them from draft_df in one merge on pfr_id (0s if the player
+    # wasn't drafted); rows without one are matched by name and position against
+    # the drafts since rookie_year-1 only, latest first, so that a rookie isn't given
+    # an older namesake's draft, defaulting to (rookie_year,0,0). entry_years
+    # overrides are applied last. rookie_year defaults to the current year.
+    import numpy as np
+    import pandas as pd
+    from .matcher import fuzzy_join
+    if rookie_year is None:
+        rookie_year = time.localtime().tm_year
+    draft_columns = ['draft_year','draft_round','draft_pick']
+    columns = list(player_df.columns)
+    player_df = player_df.drop(columns=[c for c in draft_columns if c in player_df.columns])
+    draft_info = draft_df[['pfr_id','pfr_name','position','season','round','pick']].rename(
+        columns={'season':'draft_year','round':'draft_round','pick':'draft_pick'})
+
+    pfr_ids = player_df['pfr_id'].fillna('').astype(str)
+    has_id = (pfr_ids!='').to_numpy()
+    by_id = draft_info[draft_info['pfr_id'].notna()].drop_duplicates('pfr_id')
+    merged = pd.DataFrame({'pfr_id':pfr_ids}).merge(by_id,on='pfr_id',how='left')
+    values = merged[draft_columns].fillna(0).to_numpy(dtype=np.int64)
+
+    if not all(has_id):
+        no_id = pd.DataFrame({'name':player_df['PLAYER NAME'][~has_id].tolist(),
+                              'position':player_df['POS'][~has_id].astype(str).str.replace(r'\d+','',regex=True).tolist()})
+        recent = draft_info[draft_info['draft_year']>=rookie_year-1].sort_values('draft_year',ascending=False,kind='stable')
+        matched = fuzzy_join(no_id,recent,'name','pfr_name',threshold=0.8,extra_keys=('position',))
+        fallback = matched[draft_columns].to_numpy(dtype=np.float64)
+        unmatched = np.isnan(fallback[:,0])
+        fallback[unmatched] = [rookie_year,0,0]
+        values[~has_id] = fallback.astype(np.int64)
+
+    overrides = pd.DataFrame.from_dict(entry_years_dictionary,orient='index',columns=draft_columns)
+    rows = overrides.index.get_indexer(player_df['unique_id'])
+    values[rows>-1] = overrides.to_numpy(dtype=np.int64)[rows[rows>-1]]
+
+    for k,col in enumerate(draft_columns):
+        player_df[col] = values[:,k]
+    if all([c in columns for c in draft_columns]):
+        player_df = player_df[columns]
+    return player_df
+
+def build_player_table_initial(rankings_file,workers=8,journal_filename='./data/player_table_initial.journal',rookie_year=None):
+    # rookie_year (default the current year) is the draft class treated as rookies
+    # when attaching draft info; see attach_draft_info
+    import pandas as pd
+    import relish
+    from .matcher import fuzzy_get_df
+    setup_logging()
+    teams_df = get_data('teams_df')
+    player_name_df = get_data('player_name_df')
+    draft_df = get_data('draft_df')
+
     rankings_file_stat = os.stat(rankings_file)
     rankings_age_days = (time.time()-rankings_file_stat.st_mtime)/(24.0*3600.0)
     logging.info('Rankings page is %0.1f days old.'%rankings_age_days)
@@ -96,210 +409,148 @@ def build_player_table_initial(rankings_file):
     # it uses FP's rankings to identify the players of interest (skipping defense and kicker),
     # and then Sharpe's table to connect with PFF and PFR IDs
 
-    try:
-        player_df = pd.read_csv('./data/player_table_initial.csv')
-    except Exception:
-        player_table = []
-        # Here we want to add the following columns to this row:
-        # pfr_id, which is player_name_df['pfr_id'] and draft_df['playerid'], and
-        #     which we will also google to verify
-        # draft_year,draft_pick,draft_round from draft_df['season','round','pick']
-
-        # new columns:
-        col_pfr_id = []
-        col_draft_year = []
-        col_draft_round = []
-        col_draft_pick = []
-        col_unique_id = []
-        
-        player_df_list = []
-
-        n_rows = len(rankings_df)
-        for idx,row in rankings_df.iterrows():
-            fp_name = row['PLAYER NAME']
-            print('%04d of %04d: %s'%(idx+1,n_rows,fp_name))
-            position,rank = posrank_split(row['POS'])
-            if not position in ['QB','RB','WR','TE']:
-                continue
-
-
-            player_df_list.append(row)
-            
-            team = row['TEAM']
-            team_row = teams_df[teams_df['Abbreviation']==team]
-            team_name = team_row['Name'].values[0]
-            mascot = team_name.split(' ')[-1]
-        
-            unique_id = get_id(fp_name,position,team)
-            col_unique_id.append(unique_id)
-            
-            for letter in unique_id:
-                try:
-                    assert letter in 'abcdefghijklmnopqrstuvwxyz'
-                except:
-                    print('%s is not a lower case letter'%letter)
-                    sys.exit()
-                    
-            pfr_id_relish = 'pfr_id_%s'%unique_id
-
+    # The table is rebuilt whenever the rankings file is newer than it, or some of
+    # its players have no journal record (their resolution failed last time). Rows
+    # are keyed by unique_id (name, position and team), so a rebuild takes RK, TIERS
+    # and POS from the new rankings, reuses the pfr_id and draft info of every
+    # player it already knows from the journal (seeded from the old table if there
+    # is no journal), only resolves new, team-changed or failed players and drops
+    # players who are no longer ranked.
+    table_filename = './data/player_table_initial.csv'
+    journal = BuildJournal(journal_filename)
+    if os.path.exists(table_filename) and os.stat(table_filename).st_mtime>=rankings_file_stat.st_mtime:
+        table_df = pd.read_csv(table_filename)
+        unfinished = [unique_id for unique_id in table_df['unique_id'] if not unique_id in journal]
+        if len(unfinished)==0:
+            return table_df
+        logging.info('%d players in %s have no journal record, rebuilding to retry them.'%(len(unfinished),table_filename))
+
+    # Here we want to add the following columns to this row:
+    # pfr_id, which is player_name_df['pfr_id'] and draft_df['playerid'], and
+    #     which we will also google to verify
+    # draft_year,draft_pick,draft_round from draft_df['season','round','pick']
+
+    # Every finished player is appended to the journal as soon as it's done, so
+    # if the build dies partway, rerunning it only works on the unfinished ones.
+    # A table from before there was a journal seeds it; once there is one, rows
+    # it's missing are players that failed, so they aren't seeded.
+    old_unique_ids = []
+    if os.path.exists(table_filename):
+        old_df = pd.read_csv(table_filename,keep_default_na=False)
+        old_unique_ids = old_df['unique_id'].tolist()
+        if len(journal.records)==0:
+            journal.extend([{'unique_id':unique_id,'pfr_id':str(pfr_id),'method':'table'}
+                            for unique_id,pfr_id in zip(old_df['unique_id'],old_df['pfr_id'])])
+
+    mascots = dict([(abbreviation,name.split(' ')[-1]) for abbreviation,name in zip(teams_df['Abbreviation'],teams_df['Name'])])
+
+    player_df_list = []
+    col_unique_id = []
+
+    # first pass: skip the players already in the journal, finish the ones whose
+    # pfr_id has been resolved before and queue the rest
+    jobs = {}
+    pending = {}
+    n_rows = len(rankings_df)
+    for idx,row in rankings_df.iterrows():
+        fp_name = row['PLAYER NAME']
+        position,rank = posrank_split(row['POS'])
+        if not position in ['QB','RB','WR','TE']:
+            continue
+
+        player_df_list.append(row)
+
+        team = row['TEAM']
+        mascot = mascots[team]
+        unique_id = get_id(fp_name,position,team)
+        col_unique_id.append(unique_id)
+        if unique_id in journal:
+            continue
+        print('%04d of %04d: %s'%(idx+1,n_rows,fp_name))
+
+        if not all([letter in 'abcdefghijklmnopqrstuvwxyz' for letter in unique_id]):
+            # can't be used as a relish tag; leave it for fp_pfr_lookup_helper
+            logging.error('%s is not all lower case letters, skipping pfr_id lookup for %s.'%(unique_id,fp_name))
+            journal.append({'unique_id':unique_id,'pfr_id':'','method':'invalid_id'})
+            continue
+
+        pfr_id_relish = 'pfr_id_%s'%unique_id
+        try:
+            pfr_id = relish.load(pfr_id_relish)
+        except:
+            # Sharpe's tables are only searched by name for the players we have to resolve
             player_name_sub_df = fuzzy_get_df(player_name_df,'pff_name',fp_name,return_empty=True)
             draft_sub_df = fuzzy_get_df(draft_df,'pfr_name',fp_name,threshold=0.8,verbose=False,return_empty=True)
+            jobs[pfr_id_relish] = (fp_name,position,mascot,player_name_sub_df,draft_sub_df)
+            pending[pfr_id_relish] = unique_id
+            continue
+        journal.append({'unique_id':unique_id,'pfr_id':pfr_id,'method':'relish'})
+
+    # second pass: resolve the missing pfr_ids concurrently, journaling each as
+    # it comes in; players whose resolution raised aren't journaled, so they're
+    # retried on the next build
+    def on_result(tag,pfr_id,method):
+        journal.append({'unique_id':pending[tag],'pfr_id':pfr_id,'method':method})
+    resolve_pfr_ids(jobs,workers=workers,on_result=on_result)
+
+    player_df = pd.DataFrame(player_df_list)
+    player_df['pfr_id'] = [journal.records.get(unique_id,{}).get('pfr_id','') for unique_id in col_unique_id]
+    for col in ['draft_year','draft_round','draft_pick']:
+        player_df[col] = 0
+    player_df['unique_id'] = col_unique_id
+    player_df = attach_draft_info(player_df,draft_df,rookie_year)
+
+    player_df.to_csv(table_filename)
+    n_failed = len([unique_id for unique_id in col_unique_id if not unique_id in journal])
+    if n_failed:
+        logging.warning('%d players could not be resolved and have no pfr_id; they are retried on the next build.'%n_failed)
+    new_unique_ids = set(col_unique_id)
+    logging.info('Player table: %d players, %d new since the last table, %d dropped.'%(
+        len(new_unique_ids),len(new_unique_ids-set(old_unique_ids)),len(set(old_unique_ids)-new_unique_ids)))
+    return player_df
 
-            try:
-                pfr_id = relish.load(pfr_id_relish)
-            except:
-                verbose = True
-                if verbose:
-                    print('Determining pfr_id for player %s.'%fp_name)
-
-                pfr_id_candidates = []
-                try:
-                    pfr_id_candidates.append(get_pfr_id_from_google(fp_name))
-                except:
-                    pass
 
-                if len(player_name_sub_df)>=1:
-                    pfr_id_candidates+=player_name_sub_df['pfr_id'].values.tolist()
+def build_player_table(player_table_initial_filename,fp_pfr_lookup_filename,player_table_filename,rookie_year=0):
+    import pandas as pd
+    setup_logging()
+    # Apply the hand-checked pfr_ids in fp_pfr_lookup_filename (player_name,pfr_id) to
+    # the initial player table and write it to player_table_filename. A blank pfr_id
+    # in the lookup marks a rookie. Names that appear more than once in the lookup,
+    # or not at all, keep their initial pfr_id and are returned in a report,
+    # {'duplicates': [names], 'missing': [names]}.
+    player_df = pd.read_csv(player_table_initial_filename)
+    lookup = pd.read_csv(fp_pfr_lookup_filename)
 
-                if len(draft_sub_df)>=1:
-                    pfr_id_candidates+=draft_sub_df['pfr_id'].values.tolist()
+    counts = lookup['player_name'].value_counts()
+    duplicates = counts.index[counts>1]
+    lookup = lookup[~lookup['player_name'].isin(duplicates)].set_index('player_name')['pfr_id']
 
-                if verbose:
-                    print('candidates from google, player_name_sub_df, draft_sub_df:')
-                    print('\t',pfr_id_candidates)
-
-                pfr_id_candidates = [p for p in pfr_id_candidates if type(p)==str]
-                pfr_id_candidates = [p for p in pfr_id_candidates if len(p)>4]
-
-                if len(pfr_id_candidates)>0:
-                    if verbose:
-                        print('candidates after cleanup')
-                        print(pfr_id_candidates)
-
-                    winners = poll_list(pfr_id_candidates)
-                    if verbose:
-                        print('candidates after polling')
-                        print(winners)
-
-                    for w in winners:
-                        if check_position_mascot(w,position,mascot):
-                            pfr_id = w
-                            break
-
-                    if verbose:
-                        print('winning candidate for %s is %s'%(fp_name,pfr_id))
-
-                    if pfr_id=='':
-                        if verbose:
-                            print('winning candidate was empty string')
-
-                        def pair_to_pfr(pair):
-                            return pair[1][:4]+pair[0][:2]
-
-                        def fix(s):
-                            out = []
-                            for a in s:
-                                test = a.replace("'",'').replace(',','').replace('-','')
-                                if a==test:
-                                    out.append(a)
-                                else:
-                                    out = out + [a,test]
-                            return out
-
-                        name_parts = fp_name.split()
-                        name_parts = fix(name_parts)
-                        np = len(name_parts)
-                        for k1 in range(np):
-                            for k2 in range(k1+1,np):
-                                try:
-                                    test = pair_to_pfr([name_parts[k1],name_parts[k2]])
-                                    for n in range(10):
-                                        testn = test + '%02d'%n
-                                        if verbose:
-                                            print('Brute force checking %s.'%testn)
-                                        if check_position_mascot(testn,position,mascot,verbose=True):
-                                            print('%s checks out. Using it unless dictionary specifies otherwise.'%testn)
-                                            pfr_id = testn
-                                            break
-                                except Exception as e:
-                                    print(e)
-                else:
-                    pfr_id = ''
-
-                # last, last ditch:
-                try:
-                    pfr_id = pfr_id_dict[fp_name]
-                    if verbose:
-                        print('%s specified in dictionary. Using it.'%pfr_id)
-                except:
-                    pass
-
-                if pfr_id=='':
-                    print(fp_name,'no pfr_id')
-
-                relish.save(pfr_id_relish,pfr_id)
-
-            col_pfr_id.append(pfr_id)
+    names = player_df['PLAYER NAME']
+    matched = names.isin(lookup.index)
+    duplicated = names.isin(duplicates)
+    missing = ~matched & ~duplicated
 
-            try:
-                y,r,p = entry_years_dictionary[unique_id]
-                col_draft_year.append(y)
-                col_draft_round.append(r)
-                col_draft_pick.append(p)
-            except KeyError:
-                if pfr_id=='':
-                    col_draft_year.append(2021)
-                    col_draft_round.append(0)
-                    col_draft_pick.append(0)
-                else:
-                    if len(draft_sub_df)>1:
-                        draft_sub_df = draft_sub_df[draft_sub_df['pfr_id']==pfr_id]
-                    if len(draft_sub_df)==0:
-                        col_draft_year.append(0)
-                        col_draft_round.append(0)
-                        col_draft_pick.append(0)
-                    elif len(draft_sub_df)==1:
-                        col_draft_year.append(draft_sub_df['season'].values[0])
-                        col_draft_round.append(draft_sub_df['round'].values[0])
-                        col_draft_pick.append(draft_sub_df['pick'].values[0])
-
-        player_df = pd.DataFrame(player_df_list)
-        player_df['pfr_id'] = col_pfr_id
-        player_df['draft_year'] = col_draft_year
-        player_df['draft_round'] = col_draft_round
-        player_df['draft_pick'] = col_draft_pick
-        player_df['unique_id'] = col_unique_id
-        
-        player_df.to_csv('./data/player_table_initial.csv')
-    return player_df
+    for name in names[duplicated].unique():
+        logging.error('Multiple matches for %s in pfr lookup file, keeping initial pfr_id.'%name)
+    for name in names[missing].unique():
+        logging.error('No match for %s in pfr lookup file, keeping initial pfr_id.'%name)
 
+    pfr_ids = names.map(lookup)
+    rookies = matched & pfr_ids.isna()
+    player_df['pfr_id'] = player_df['pfr_id'].astype(object)
+    player_df.loc[matched,'pfr_id'] = pfr_ids[matched]
+    player_df.loc[rookies,'pfr_id'] = ''
+    player_df.loc[rookies,'draft_year'] = rookie_year
+    player_df.loc[rookies,'draft_round'] = 0
+    player_df.loc[rookies,'draft_pick'] = 0
 
-def build_player_table(player_table_initial_filename,fp_pfr_lookup_filename,player_table_filename,rookie_year=0):
-    player_df = pd.read_csv(player_table_initial_filename)
-    lookup = pd.read_csv(fp_pfr_lookup_filename)
-    out = []
-    outcols = player_df.columns
-    for idx,row in player_df.iterrows():
-        name = row['PLAYER NAME']
-        temp = lookup[lookup['player_name']==name]
-        if len(temp)==1:
-            row['pfr_id'] = temp['pfr_id'].values[0]
-            test = temp['pfr_id'].values[0]
-            if not type(test)==str:
-                # assume rookie
-                row['pfr_id'] = ''
-                row['draft_year'] = rookie_year
-                row['draft_round'] = 0
-                row['draft_pick'] = 0
-        else:
-            logging.error('Fatal error--multiple matches in pfr lookup file.')
-            for eidx,erow in temp.iterrows():
-                logging.error(erow.tolist())
-        out.append(row)
-    outdf = pd.DataFrame(out,columns=outcols)
-    outdf.to_csv(player_table_filename)
+    player_df.to_csv(player_table_filename)
+    return {'duplicates':names[duplicated].unique().tolist(),'missing':names[missing].unique().tolist()}
 
 def fp_pfr_lookup_helper(player_table_initial_filename,html_output_filename,csv_output_filename):
+    import pandas as pd
+    from .pfr_tools import pfr_id_to_url
+    setup_logging()
     players_df = pd.read_csv(player_table_initial_filename)
     players = players_df_to_players(players_df)
 
@@ -325,6 +576,15 @@ def fp_pfr_lookup_helper(player_table_initial_filename,html_output_filename,csv_
 
 
 def build_league(league_id, year, player_table_filename, use_cached=False):
+    import numpy as np
+    import pandas as pd
+    import relish
+    import requests_cache
+    from .matcher import fuzzy_join
+    from . import fetcher
+    setup_logging()
+    teams_df = get_data('teams_df')
+    owners_df = get_data('owners_df')
 
     players_df = pd.read_csv(player_table_filename)
     relish_id = 'league_%d_%d'%(league_id,year)
@@ -339,19 +599,19 @@ def build_league(league_id, year, player_table_filename, use_cached=False):
             
     os.makedirs('.requests_cache',exist_ok=True)
     
-    requests_cache.install_cache(cache_name='.requests_cache/espn_cache', backend='sqlite', expire_after=72000000)
+    espn_session = requests_cache.CachedSession(cache_name='.requests_cache/espn_cache', backend='sqlite', expire_after=72000000)
 
     url = "https://fantasy.espn.com/apis/v3/games/ffl/seasons/%d/segments/0/leagues/%d"%(year,league_id)
     swid_cookie = '720838F2-19CB-4C50-8AB7-41E1D10796F0'
     espn_s2_cookie = 'AECabeD%2F6A2ggL51TfzwstV8JoDHLvMAbfcbnSaJe6765VrE%2FYsS%2BHv1Zja6Hc6HFDU12buqeI61zjprVioYcZga8NMV1zlabmxIenG4anG7YclvaQH68VsyA0LqvfnSTSOM%2BoiivVS1kvA0%2BZ29cMjnq5dFOozySFshoxNLYUJGBNt7045cKBHJDI1oDcmnEdl3OGvDY8E2bP%2B4cUFIWqA4PkFv3leHeFzNKZPkrEJ%2FYET0F2oaLcr7ta7VCXZ%2Bt4rQ%2Bl8l5ylCMH8jyJOBtR7z'
     now = time.ctime(int(time.time()))
-    roster_page = requests.get(url,
+    roster_page = fetcher.get(url,session=espn_session,
                                cookies={"swid": swid_cookie,
                                         "espn_s2": espn_s2_cookie},
                                params={"view": "mRoster"})
     logging.info("Got ESPN roster data; time: {0} / used cache: {1}".format(now, roster_page.from_cache))
     now = time.ctime(int(time.time()))
-    team_page = requests.get(url,
+    team_page = fetcher.get(url,session=espn_session,
                                cookies={"swid": swid_cookie,
                                         "espn_s2": espn_s2_cookie},
                                params={"view": "mTeam"})
@@ -379,43 +639,79 @@ def build_league(league_id, year, player_table_filename, use_cached=False):
         value = '%s (%s)'%(city,abbreviation)
         defense_lut[key] = value
 
-    league = League()
+    # lookup tables, built once: ESPN team id -> abbreviation, owner id -> owner
+    # record and unique_id -> row position in players_df (ids that appear more
+    # than once in players_df are left out and matched by name below)
+    espn_abbreviations = dict(zip(teams_df['ESPN_ID'].tolist(),teams_df['Abbreviation'].tolist()))
+    owner_records = dict(zip(owners_df['id'].tolist(),owners_df.to_dict('records')))
+    player_table = PlayerTable(players_df)
+    player_rows = {}
+    duplicate_ids = set()
+    for row_position,unique_id in enumerate(players_df['unique_id'].tolist()):
+        if unique_id in player_rows:
+            duplicate_ids.add(unique_id)
+        player_rows[unique_id] = row_position
+    for unique_id in duplicate_ids:
+        del player_rows[unique_id]
+
+    # first pass: look up each rostered player by unique_id
+    entries = []
+    misses = []
     for item in roster_dict['teams']:
-        team_id = item['id']
-        owner_series = owners_df.loc[owners_df['id'] == team_id].iloc[0]
-        owner = owner_series['OWNER NAME']
-        team_abbr = owner_series['ABBRV']
-        team_name = owner_series['NAME']
-
-        team = Team(team_id,team_abbr,team_name,owner)
-
-        team_roster = item['roster']
-        
-        for player_data in team_roster['entries']:
+        for player_data in item['roster']['entries']:
             espn_row = player_data['playerPoolEntry']['player']
             name = espn_row['fullName']
             position = position_dict[espn_row['defaultPositionId']]
-            team_name = teams_df[teams_df['ESPN_ID']==espn_row['proTeamId']]['Abbreviation'].values[0]
-            try:
-                test_id = get_id(name,position,team_name)
-                players = players_df[players_df['unique_id']==test_id]
-                assert len(players)==1
-            except AssertionError as ae:
-                players = fuzzy_get_df(players_df,'PLAYER NAME',name)
-                if not players is None:
-                    if len(players)>1:
-                        players = players[players['POS']==position]
-                    if len(players)>1:
-                        players = players[players['TEAM']==team_name]
-                    if not len(players)==1:
-                        sys.exit('Could not locate player with name %s, team %s, position %s in player table.'%(name,team_name,position))
-
-            # At this stage, players is either a 1 row dataframe containing the player info or None, in the case
-            # of unranked players, kickers, defenses, etc.
-            p = Player(name,position,team_name,players)
-            team.add_player(p)
-
-        league.append(team)
+            team_name = espn_abbreviations[espn_row['proTeamId']]
+            row_position = player_rows.get(get_id(name,position,team_name),-1)
+            if row_position==-1:
+                misses.append((len(entries),name,position,team_name))
+            entries.append([item['id'],name,position,team_name,row_position])
+
+    # second pass: match the leftovers (players who changed teams, name variants,
+    # and kickers and defenses, which aren't in the table) by name within position
+    if len(misses):
+        misses_df = pd.DataFrame(misses,columns=['entry','name','position','team'])
+        table_df = pd.DataFrame({'PLAYER NAME':players_df['PLAYER NAME'],
+                                 'position':players_df['POS'].astype(str).str.replace(r'\d+','',regex=True),
+                                 'table_row':np.arange(len(players_df))})
+        matched = fuzzy_join(misses_df,table_df,'name','PLAYER NAME',threshold=0.85,extra_keys=('position',))
+        # fuzzy_join gives the first of several rows with the matched name (e.g. two
+        # WRs named Mike Williams); those are settled by team, or left unmatched
+        same_name = {}
+        for table_row,(table_name,table_position) in enumerate(zip(table_df['PLAYER NAME'].tolist(),table_df['position'].tolist())):
+            if type(table_name)==str:
+                same_name.setdefault((table_name.lower().strip(),table_position),[]).append(table_row)
+        table_teams = players_df['TEAM'].tolist()
+        n_matched = 0
+        for entry,name,position,team_name,table_name,table_row in zip(*[matched[c].tolist() for c in ['entry','name','position','team','PLAYER NAME','table_row']]):
+            if np.isnan(table_row):
+                continue
+            rows = same_name[(table_name.lower().strip(),position)]
+            if len(rows)>1:
+                rows = [r for r in rows if table_teams[r]==team_name]
+                if not len(rows)==1:
+                    logging.warning('%s (%s, %s) matches more than one %s in the player table; leaving it unmatched.'%(name,position,team_name,table_name))
+                    continue
+            entries[entry][4] = rows[0]
+            n_matched+=1
+        logging.info('Matched %d of %d rostered players without a unique_id match by name.'%(n_matched,len(misses)))
+
+    league = League()
+    teams = {}
+    for item in roster_dict['teams']:
+        team_id = item['id']
+        owner_record = owner_records[team_id]
+        teams[team_id] = Team(team_id,owner_record['ABBRV'],owner_record['NAME'],owner_record['OWNER NAME'])
+        league.append(teams[team_id])
+
+    for team_id,name,position,team_name,row_position in entries:
+        # players without a row in the table are unranked players, kickers, defenses, etc.
+        if row_position==-1:
+            p = Player(name,position,team_name)
+        else:
+            p = player_table.player(row_position,name,position,team_name)
+        teams[team_id].add_player(p)
 
     league.teams.sort()
     relish.save(relish_id,league)
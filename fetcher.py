@@ -0,0 +1,178 @@
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+import logging
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# All of the package's web requests go through here: one pooled requests.Session
+# (so connections and TLS handshakes are reused per host), a cap on simultaneous
+# requests per host, per-host rate limits, retries with exponential backoff that
+# honour Retry-After, and counters of requests and latency per host.
+
+class RateLimiter:
+    # Token bucket shared by all threads fetching from one host: at most burst
+    # requests at once, refilled at one token every min_interval seconds.
+
+    def __init__(self,min_interval,burst=1):
+        self.min_interval = min_interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # reserve a token under the lock, then sleep (outside it) until it is due
+        with self.lock:
+            now = time.monotonic()
+            if self.min_interval>0:
+                self.tokens = min(self.burst,self.tokens+(now-self.updated)/self.min_interval)
+            else:
+                self.tokens = self.burst
+            self.updated = now
+            self.tokens-=1
+            if self.tokens>=0:
+                wait = 0.0
+            else:
+                wait = -self.tokens*self.min_interval
+        if wait>0:
+            time.sleep(wait)
+        return wait
+
+# seconds between requests per host; PFR asks for no more than 20 requests a minute,
+# and Google starts answering 429 if searched more than about once every 45 s
+host_limiters = {'www.pro-football-reference.com':RateLimiter(3.0),
+                 'www.google.com':RateLimiter(45.0)}
+host_limiters_lock = threading.Lock()
+
+def set_rate_limit(host,min_interval,burst=1):
+    with host_limiters_lock:
+        try:
+            limiter = host_limiters[host]
+            limiter.min_interval = min_interval
+            limiter.burst = burst
+        except KeyError:
+            host_limiters[host] = RateLimiter(min_interval,burst)
+
+def wait_for_host(url):
+    # block until the url's host may be sent another request
+    host = urlparse(url).netloc
+    with host_limiters_lock:
+        limiter = host_limiters.get(host)
+    if limiter is None:
+        return 0.0
+    return limiter.acquire()
+
+class Fetcher:
+
+    retry_statuses = [429,500,502,503,504]
+
+    def __init__(self,max_per_host=2,max_retries=4,backoff=2.0,max_backoff=600.0,timeout=30.0):
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16,pool_maxsize=max(max_per_host,10))
+        self.session.mount('https://',adapter)
+        self.session.mount('http://',adapter)
+        self.session.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36"})
+        self.semaphores = {}
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def host_semaphore(self,host):
+        with self.lock:
+            try:
+                return self.semaphores[host]
+            except KeyError:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+                return self.semaphores[host]
+
+    def record(self,host,key,value=1):
+        with self.lock:
+            counts = self.metrics.setdefault(host,{'requests':0,'retries':0,'errors':0,'seconds':0.0,'max_seconds':0.0,'statuses':{}})
+            if key=='seconds':
+                counts['seconds']+=value
+                counts['max_seconds'] = max(counts['max_seconds'],value)
+            elif key=='status':
+                counts['statuses'][value] = counts['statuses'].get(value,0)+1
+            else:
+                counts[key]+=value
+
+    def stats(self):
+        # {host: {'requests','retries','errors','seconds','max_seconds','mean_seconds','statuses'}}
+        with self.lock:
+            out = {}
+            for host,counts in self.metrics.items():
+                out[host] = dict(counts)
+                out[host]['statuses'] = dict(counts['statuses'])
+                if counts['requests']:
+                    out[host]['mean_seconds'] = counts['seconds']/counts['requests']
+                else:
+                    out[host]['mean_seconds'] = 0.0
+            return out
+
+    def retry_delay(self,response,attempt):
+        # Retry-After (seconds or an HTTP date) if the server sent one, otherwise
+        # exponential backoff
+        delay = self.backoff*2**attempt
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    try:
+                        delay = parsedate_to_datetime(retry_after).timestamp()-time.time()
+                    except (TypeError,ValueError):
+                        pass
+        return min(max(delay,0.0),self.max_backoff)
+
+    def get(self,url,session=None,**kwargs):
+        # Like requests.get(url,**kwargs). session can be another requests.Session
+        # (e.g. a requests_cache.CachedSession) to send the request through. The
+        # last response is returned even if it's an error; connection errors are
+        # raised once the retries are used up.
+        if session is None:
+            session = self.session
+        kwargs.setdefault('timeout',self.timeout)
+        host = urlparse(url).netloc
+        semaphore = self.host_semaphore(host)
+        for attempt in range(self.max_retries+1):
+            response = None
+            error = None
+            with semaphore:
+                wait_for_host(url)
+                t0 = time.time()
+                try:
+                    response = session.get(url,**kwargs)
+                except requests.exceptions.RequestException as e:
+                    error = e
+                self.record(host,'requests')
+                self.record(host,'seconds',time.time()-t0)
+            if response is not None:
+                self.record(host,'status',response.status_code)
+                if not response.status_code in self.retry_statuses:
+                    return response
+            else:
+                self.record(host,'errors')
+            if attempt==self.max_retries:
+                break
+            delay = self.retry_delay(response,attempt)
+            logging.info('Retrying %s in %0.1f s (attempt %d of %d).'%(url,delay,attempt+2,self.max_retries+1))
+            self.record(host,'retries')
+            time.sleep(delay)
+        if response is None:
+            raise error
+        return response
+
+default_fetcher = Fetcher()
+
+def get(url,session=None,**kwargs):
+    return default_fetcher.get(url,session=session,**kwargs)
+
+def stats():
+    return default_fetcher.stats()
@@ -0,0 +1,206 @@
+import pandas as pd
+import numpy as np
+import os,glob
+import time
+import threading
+import logging
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    # conform_gamelog works without pyarrow; GamelogStore doesn't
+    pa = None
+
+# Gamelogs kept as one Parquet dataset per season (./.gamelogs/season=2021/...),
+# with a fixed, typed schema so that a whole season can be read in one go and
+# queries by pfr_id and week only touch the row groups that can match. Writes add
+# small fragment files; compact() merges a season back into a single sorted file.
+
+gamelog_text_columns = ['pfr_id','Player','Date','Tm','Opp','Result','GS']
+
+gamelog_int_columns = ['Rk','G#','Week']
+
+gamelog_stat_columns = ['Age','Passing_Cmp','Passing_Att','Passing_Yds','Passing_TD','Passing_Int',
+                        'Passing_Rate','Passing_Sk','Passing_Yds.1','Passing_Y/A','Passing_AY/A',
+                        'Rushing_Att','Rushing_Yds','Rushing_Y/A','Rushing_TD',
+                        'Receiving_Tgt','Receiving_Rec','Receiving_Yds','Receiving_Y/R','Receiving_TD',
+                        'Scoring_TD','Scoring_Pts','Fumbles_Fmb','Fumbles_FL','Fumbles_FF','Fumbles_FR',
+                        'Fumbles_Yds','Fumbles_TD','Off. Snaps_Num']
+
+if pa is not None:
+    gamelog_schema = pa.schema([(c,pa.string()) for c in gamelog_text_columns]+
+                               [(c,pa.int16()) for c in gamelog_int_columns]+
+                               [(c,pa.float32()) for c in gamelog_stat_columns]+
+                               [('fpts',pa.float64()),('written',pa.int64())])
+
+def conform_gamelog(df):
+    # The one shape every gamelog is returned in, whatever it was read from: the
+    # columns above (and fpts) in that order, text as str or None, Rk, G# and Week
+    # as nullable Int16, stats as float32 and fpts as float64. Unknown columns are
+    # dropped and missing ones are null.
+    n = len(df)
+    columns = {}
+    for c in gamelog_text_columns:
+        if c in df.columns:
+            columns[c] = [None if (v is None or (type(v)==float and np.isnan(v))) else str(v) for v in df[c].tolist()]
+        else:
+            columns[c] = [None]*n
+    for c in gamelog_int_columns:
+        if c in df.columns:
+            columns[c] = pd.to_numeric(df[c],errors='coerce').astype('Int16').values
+        else:
+            columns[c] = pd.array([None]*n,dtype='Int16')
+    for c in gamelog_stat_columns:
+        if c in df.columns:
+            columns[c] = pd.to_numeric(df[c],errors='coerce').astype(np.float32).values
+        else:
+            columns[c] = np.full(n,np.nan,dtype=np.float32)
+    if 'fpts' in df.columns:
+        columns['fpts'] = pd.to_numeric(df['fpts'],errors='coerce').astype(np.float64).values
+    else:
+        columns['fpts'] = np.full(n,np.nan)
+    return pd.DataFrame(columns)
+
+class GamelogStore:
+    # Reads go through an in-memory copy of each season, loaded from its files on
+    # first use and indexed by pfr_id, so a player's gamelog is a slice of it
+    # rather than a scan of every fragment. Writes go to disk and into that copy.
+
+    def __init__(self,root='./.gamelogs',memory_map=False,max_fragments=64):
+        # memory_map=True reads the Parquet files through memory maps
+        if pa is None:
+            raise ImportError('GamelogStore needs pyarrow.')
+        self.root = root
+        self.memory_map = memory_map
+        self.max_fragments = max_fragments
+        self.seasons = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def season_dir(self,year):
+        return os.path.join(self.root,'season=%d'%year)
+
+    def fragments(self,year):
+        return sorted(glob.glob(os.path.join(self.season_dir(year),'*.parquet')))
+
+    def to_table(self,df):
+        # a conformed gamelog DataFrame (see conform_gamelog) as a table in gamelog_schema
+        df = df.assign(written=np.full(len(df),time.time_ns(),dtype=np.int64))
+        return pa.Table.from_pandas(df,schema=gamelog_schema,preserve_index=False)
+
+    def write(self,df,year,pfr_id=None):
+        # Add df's rows to year's dataset. Rows for a (pfr_id,Week) already stored
+        # are superseded by the newest write. pfr_id fills in a missing pfr_id column.
+        if len(df)==0:
+            return
+        if pfr_id is not None and not 'pfr_id' in df.columns:
+            df = df.assign(pfr_id=pfr_id)
+        df = conform_gamelog(df)
+        table = self.to_table(df)
+        with self.lock:
+            os.makedirs(self.season_dir(year),exist_ok=True)
+            fn = os.path.join(self.season_dir(year),'part-%020d.parquet'%time.time_ns())
+            pq.write_table(table,fn)
+            # merged into the in-memory season on its next read
+            if year in self.seasons:
+                self.pending.setdefault(year,[]).append(df)
+        if len(self.fragments(year))>self.max_fragments:
+            self.compact(year)
+
+    def scan(self,year,pfr_ids=None,weeks=None):
+        # Stored gamelogs for year read straight from the files, optionally only for
+        # some pfr_ids and weeks, with the filters pushed down to the Parquet reader.
+        # Sorted by pfr_id and Week. read() is faster for repeated lookups.
+        fragments = self.fragments(year)
+        if len(fragments)==0:
+            return pd.DataFrame([])
+        filters = []
+        if pfr_ids is not None:
+            filters.append(ds.field('pfr_id').isin(list(pfr_ids)))
+        if weeks is not None:
+            filters.append(ds.field('Week').isin([int(w) for w in weeks]))
+        expression = None
+        for f in filters:
+            if expression is None:
+                expression = f
+            else:
+                expression = expression & f
+        if self.memory_map:
+            table = pa.concat_tables([pq.read_table(fn,schema=gamelog_schema,filters=expression,memory_map=True) for fn in fragments])
+        else:
+            table = ds.dataset(fragments,schema=gamelog_schema).to_table(filter=expression)
+        df = table.to_pandas()
+        if len(df)==0:
+            return pd.DataFrame([])
+        # newest write wins for each player-week
+        df = df.sort_values('written',kind='stable').drop_duplicates(['pfr_id','Week'],keep='last')
+        df = df.sort_values(['pfr_id','Week'])
+        return conform_gamelog(df)
+
+    def season(self,year):
+        # (in-memory season table, {pfr_id: positions of its rows in the table})
+        with self.lock:
+            if not year in self.seasons:
+                df = self.scan(year)
+                if len(df)==0:
+                    df = conform_gamelog(df)
+                self.seasons[year] = (df,df.groupby('pfr_id',sort=False).indices)
+            pending = self.pending.pop(year,[])
+            if len(pending):
+                df = pd.concat([self.seasons[year][0]]+pending,ignore_index=True)
+                df = df.drop_duplicates(['pfr_id','Week'],keep='last')
+                df = df.sort_values(['pfr_id','Week'],kind='stable').reset_index(drop=True)
+                self.seasons[year] = (df,df.groupby('pfr_id',sort=False).indices)
+            return self.seasons[year]
+
+    def read(self,year,pfr_ids=None,weeks=None):
+        # Stored gamelogs for year, optionally only for some pfr_ids and weeks,
+        # sliced from the in-memory season. Sorted by pfr_id and Week.
+        df,rows = self.season(year)
+        if pfr_ids is None:
+            df = df.copy()
+        else:
+            positions = [rows[p] for p in sorted(set(pfr_ids)) if p in rows]
+            if len(positions)==0:
+                return pd.DataFrame([])
+            df = df.iloc[np.concatenate(positions)]
+        if weeks is not None:
+            df = df[df['Week'].isin([int(w) for w in weeks])]
+        if len(df)==0:
+            return pd.DataFrame([])
+        return df.reset_index(drop=True)
+
+    def read_players(self,year,pfr_ids):
+        # {pfr_id: gamelog} for each of pfr_ids stored for year, from one pass over
+        # the in-memory season; for callers that want many players' gamelogs
+        df,rows = self.season(year)
+        return dict([(p,df.iloc[rows[p]].reset_index(drop=True)) for p in pfr_ids if p in rows])
+
+    def has_player(self,year,pfr_id):
+        df,rows = self.season(year)
+        return pfr_id in rows
+
+    def last_weeks(self,year):
+        # {pfr_id: (last week stored,team in that week)} for a season
+        df,rows = self.season(year)
+        df = df.dropna(subset=['pfr_id','Week']).drop_duplicates('pfr_id',keep='last')
+        return dict(zip(df['pfr_id'],zip(df['Week'].astype(int),df['Tm'])))
+
+    def compact(self,year,row_group_size=2048):
+        # merge a season's fragments into one file sorted by pfr_id and Week, whose
+        # row group statistics let reads by pfr_id skip most of the file
+        with self.lock:
+            fragments = self.fragments(year)
+            if len(fragments)<2:
+                return
+            table = ds.dataset(fragments,schema=gamelog_schema).to_table()
+            df = table.to_pandas()
+            df = df.sort_values('written',kind='stable').drop_duplicates(['pfr_id','Week'],keep='last')
+            df = df.sort_values(['pfr_id','Week'])
+            table = pa.Table.from_pandas(df,schema=gamelog_schema,preserve_index=False)
+            fn = os.path.join(self.season_dir(year),'part-%020d.parquet'%time.time_ns())
+            pq.write_table(table,fn,row_group_size=row_group_size)
+            for old in fragments:
+                os.remove(old)
+            logging.info('Compacted %d gamelog fragments for %d.'%(len(fragments),year))
@@ -0,0 +1,48 @@
+import subprocess
+import sys,os
+import numpy as np
+
+# Startup benchmark: times `import fantasy_tools` in fresh interpreters and lists
+# which of the heavy dependencies the import pulled in. Run it with
+#     python -m fantasy_tools.import_benchmark [n_runs]
+# from the directory containing the package.
+
+heavy_modules = ['numpy','pandas','matplotlib','requests','requests_cache','bs4','relish','nfldata',
+                 'pyarrow','fantasy_tools.pfr_tools','fantasy_tools.scraper','fantasy_tools.matcher']
+
+timing_script = '''import time
+t0 = time.perf_counter()
+import %(package)s
+t1 = time.perf_counter()
+import sys
+print(t1-t0)
+print(','.join([m for m in %(heavy)r if m in sys.modules]))
+'''
+
+def time_import(package='fantasy_tools',n_runs=10):
+    # (list of import times in seconds, heavy modules loaded by the import)
+    parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    heavy = [m.replace('fantasy_tools',package) for m in heavy_modules]
+    script = timing_script%{'package':package,'heavy':heavy}
+    times = []
+    loaded = []
+    for k in range(n_runs):
+        out = subprocess.run([sys.executable,'-c',script],cwd=parent,capture_output=True,text=True,check=True)
+        lines = out.stdout.split('\n')
+        times.append(float(lines[0]))
+        loaded = [m for m in lines[1].split(',') if len(m)]
+    return times,loaded
+
+if __name__=='__main__':
+    try:
+        n_runs = int(sys.argv[1])
+    except IndexError:
+        n_runs = 10
+    package = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+    times,loaded = time_import(package,n_runs)
+    times = np.array(times)*1000.0
+    print('import %s: min %0.1f ms, median %0.1f ms, max %0.1f ms over %d runs'%(package,times.min(),np.median(times),times.max(),n_runs))
+    if len(loaded):
+        print('heavy modules loaded at import: %s'%', '.join(loaded))
+    else:
+        print('no heavy modules loaded at import')
@@ -1,17 +1,87 @@
 from difflib import SequenceMatcher
 import numpy as np
 import sys,os
-from matplotlib import pyplot as plt
+import re
+from collections import OrderedDict,Counter
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import weakref
 
-def similarity(a, b):
+class SimilarityCache:
+    # Bounded least-recently-used store of SequenceMatcher ratios, with counters
+    # for how often a pair is served from cache, rejected early, or computed.
+
+    def __init__(self,maxsize=200000):
+        self.maxsize = maxsize
+        self.ratios = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.rejects = 0
+
+    def clear(self):
+        self.ratios.clear()
+        self.reset_stats()
+
+    def get(self,pair):
+        ratio = self.ratios.get(pair)
+        if ratio is not None:
+            self.ratios.move_to_end(pair)
+            self.hits+=1
+        return ratio
+
+    def put(self,pair,ratio):
+        self.misses+=1
+        self.ratios[pair] = ratio
+        if len(self.ratios)>self.maxsize:
+            self.ratios.popitem(last=False)
+
+    def stats(self):
+        calls = self.hits+self.misses+self.rejects
+        if calls:
+            hit_rate = self.hits/float(calls)
+            reject_rate = self.rejects/float(calls)
+        else:
+            hit_rate = reject_rate = 0.0
+        return {'calls':calls,'hits':self.hits,'misses':self.misses,'rejects':self.rejects,
+                'hit_rate':hit_rate,'reject_rate':reject_rate,'size':len(self.ratios)}
+
+similarity_cache = SimilarityCache()
+
+def similarity_stats():
+    return similarity_cache.stats()
+
+def similarity(a, b, threshold=None):
+    # SequenceMatcher ratio of a and b, memoized in similarity_cache. If threshold is
+    # given, pairs whose length or character-count upper bounds (the same bounds as
+    # real_quick_ratio and quick_ratio) fall below it return 0.0 without computing
+    # the full ratio, so only compare the result against the same threshold.
     try:
-        return SequenceMatcher(None, a, b).ratio()
+        pair = (a,b)
+        ratio = similarity_cache.get(pair)
+        if ratio is not None:
+            return ratio
+        if threshold is not None:
+            total = len(a)+len(b)
+            if total and 2.0*min(len(a),len(b))/total<threshold:
+                similarity_cache.rejects+=1
+                return 0.0
+            if total and 2.0*sum((Counter(a)&Counter(b)).values())/total<threshold:
+                similarity_cache.rejects+=1
+                return 0.0
+        ratio = SequenceMatcher(None, a, b).ratio()
+        similarity_cache.put(pair,ratio)
+        return ratio
     except Exception as e:
         return 0.0
     
-def fuzzy_get_df(df,column,string,threshold=.85,verbose=False,return_empty=False):
+def fuzzy_get_df(df,column,string,threshold=.85,verbose=False,return_empty=False,indexed=True):
     # return row of df where its column matches (or near matches) string
+    # indexed=False does the original full scan of the column with similarity()
+    if indexed and type(string)==str:
+        return get_name_index(df,column).get_df(string,threshold=threshold,verbose=verbose,return_empty=return_empty)
     match = df[df[column]==string]
     if verbose:
         print('Initial match: %s.'%match)
@@ -27,7 +97,7 @@ def fuzzy_get_df(df,column,string,threshold=.85,verbose=False,return_empty=False
             try:
                 if verbose>1:
                     print(type(candidate),type(string))
-                score = similarity(candidate,string)
+                score = similarity(candidate,string,threshold)
                 if verbose>1:
                     print('Comparing %s and %s: %0.2f'%(candidate,string,score))
                 scores.append(score)
@@ -49,6 +119,237 @@ def fuzzy_get_df(df,column,string,threshold=.85,verbose=False,return_empty=False
             else:
                 return None
 
+def normalize_name(s):
+    # lower case, punctuation removed, whitespace collapsed
+    s = re.sub(r"[^\w\s]",'',s.lower())
+    return ' '.join(s.split())
+
+def name_ngrams(s,n=3):
+    padded = ' '*(n-1)+s+' '
+    return set([padded[k:k+n] for k in range(len(padded)-n+1)])
+
+class NameIndex:
+    # Index of one string column of a DataFrame for repeated fuzzy lookups. Exact
+    # matches are a dictionary probe; otherwise rows sharing character n-grams with
+    # the (normalized) query are counted through an inverted index and only the
+    # best max_candidates of them are rescored with similarity(), using the same
+    # threshold test as the full scan in fuzzy_get_df.
+
+    def __init__(self,df,column,n=3,max_candidates=50):
+        # only a weak reference to df is kept, so a cached index doesn't keep it alive
+        self.df_ref = weakref.ref(df)
+        self.column = column
+        self.n = n
+        self.max_candidates = max_candidates
+        self.values = df[column].tolist()
+        self.stamp = frame_stamp(df,[column])
+        self.positions = {}
+        self.ngram_index = {}
+        self.first_position = {}
+        for pos,value in enumerate(self.values):
+            if not type(value)==str:
+                continue
+            if value in self.positions:
+                self.positions[value].append(pos)
+                continue
+            self.positions[value] = [pos]
+            self.first_position[value] = pos
+            for gram in name_ngrams(normalize_name(value),n):
+                self.ngram_index.setdefault(gram,[]).append(value)
+
+    @property
+    def df(self):
+        return self.df_ref()
+
+    def is_current(self,df):
+        # False if df isn't the indexed frame or its length or column has been replaced
+        # since (see frame_stamp)
+        return self.df is df and frame_stamp(df,[self.column])==self.stamp
+
+    def candidates(self,string):
+        counts = {}
+        for gram in name_ngrams(normalize_name(string),self.n):
+            for value in self.ngram_index.get(gram,[]):
+                counts[value] = counts.get(value,0)+1
+        ranked = sorted(counts.keys(),key=lambda v: (-counts[v],self.first_position[v]))
+        return ranked[:self.max_candidates]
+
+    def best_match(self,string,threshold=None):
+        # returns (value,score) of the closest entry, or (None,0.0); with a threshold,
+        # entries that can't reach it are skipped early (see similarity)
+        if string in self.positions:
+            return string,1.0
+        winner = None
+        best_score = 0.0
+        for value in self.candidates(string):
+            score = similarity(value,string,threshold)
+            # ties go to the earlier row, like np.argmax over the whole column
+            if score>best_score or (score==best_score and winner is not None and self.first_position[value]<self.first_position[winner]):
+                winner = value
+                best_score = score
+        return winner,best_score
+
+    def get_df(self,string,threshold=.85,verbose=False,return_empty=False):
+        value,score = self.best_match(string,threshold)
+        if value==string or (value is not None and score>threshold):
+            if verbose:
+                print('Matched %s to %s (%0.2f).'%(string,value,score))
+            return self.df.iloc[self.positions[value]]
+        if verbose:
+            print('No valid entry for %s.'%string)
+        if return_empty:
+            return pd.DataFrame([])
+        return None
+
+def frame_stamp(df,columns):
+    # A cheap stand-in for the contents of df's columns, for telling whether an index
+    # built from them is out of date: the frame's length and the address of each
+    # column's values. Assigning a new column or adding rows changes it, but editing
+    # cells in place does not, so rebuild an index explicitly after doing that.
+    return (len(df),)+tuple([np.asarray(df[c]).__array_interface__['data'][0] for c in columns])
+
+def cached_frame_index(cache,df,key,build,rebuild=False):
+    # The index in cache (a dictionary keyed by (id(df),)+key) for df, made with
+    # build() if there's none, it's no longer current, or rebuild is True. Indices
+    # only hold weak references to their frames, and a frame's entries are dropped
+    # from cache when it's garbage collected.
+    full_key = (id(df),)+key
+    index = cache.get(full_key)
+    if rebuild or index is None or not index.is_current(df):
+        index = build()
+        if not full_key in cache:
+            weakref.finalize(df,cache.pop,full_key,None)
+        cache[full_key] = index
+    return index
+
+name_indices = {}
+
+def get_name_index(df,column,rebuild=False):
+    # NameIndex for (df,column), built on first request and reused while the
+    # column is unchanged; rebuild=True after editing the column's cells in place
+    return cached_frame_index(name_indices,df,(column,),lambda: NameIndex(df,column),rebuild)
+
+def match_block_names(left_names,right_names,threshold):
+    # Match each of left_names against right_names (one block of a fuzzy_join).
+    # Returns a list of (position in right_names,score,method) with position -1
+    # for no match. Methods are tried in the order used by get_matching_name:
+    # exact (case-insensitive), truncation (one name's words are a prefix of the
+    # other's), then statistical (similarity at or above threshold).
+    cleaned = [n.lower().strip() if type(n)==str else '' for n in right_names]
+    exact = {}
+    for pos,name in enumerate(cleaned):
+        if len(name) and not name in exact:
+            exact[name] = pos
+    tokens = [tuple(name.split()) for name in cleaned]
+    index = None
+    out = []
+    for name in left_names:
+        if not type(name)==str:
+            out.append((-1,0.0,''))
+            continue
+        name = name.lower().strip()
+        if name in exact:
+            out.append((exact[name],1.0,'exact'))
+            continue
+        name_tokens = tuple(name.split())
+        if len(name_tokens)==0:
+            out.append((-1,0.0,''))
+            continue
+        found = -1
+        for pos,right_tokens in enumerate(tokens):
+            if len(right_tokens) and not len(right_tokens)==len(name_tokens):
+                n_terms = min(len(right_tokens),len(name_tokens))
+                if right_tokens[:n_terms]==name_tokens[:n_terms]:
+                    found = pos
+                    break
+        if found>-1:
+            out.append((found,similarity(cleaned[found],name),'truncation'))
+            continue
+        if index is None:
+            index = NameIndex(pd.DataFrame({'name':cleaned}),'name')
+        value,score = index.best_match(name,threshold)
+        if value is not None and score>=threshold:
+            out.append((index.positions[value][0],score,'statistical'))
+        else:
+            out.append((-1,score,''))
+    return out
+
+def match_blocks(blocks,threshold):
+    # blocks is a list of (left_names,right_names) pairs; run in worker processes
+    return [match_block_names(left_names,right_names,threshold) for left_names,right_names in blocks]
+
+def fuzzy_join(left_df,right_df,left_col,right_col,threshold=0.9,extra_keys=('position','team'),how='left',workers=1,suffix='_right'):
+    # Match every row of left_df to at most one row of right_df by name, in bulk.
+    # Rows are only compared within blocks that agree on extra_keys; each key is
+    # a column name present in both frames, or a (left column,right column) pair.
+    # The blocks are split over worker processes if workers>1 (None for one per CPU).
+    # Returns left_df with the matched right_df columns appended (clashing names get
+    # suffix) plus match_score and match_method ('exact','truncation','statistical',
+    # or '' if unmatched). how='inner' drops unmatched rows.
+    key_pairs = []
+    for key in extra_keys:
+        if type(key)==str:
+            key_pairs.append((key,key))
+        else:
+            key_pairs.append(tuple(key))
+
+    def block_keys(df,cols):
+        if len(cols)==0:
+            return [()]*len(df)
+        return list(zip(*[df[c].tolist() for c in cols]))
+
+    left_keys = block_keys(left_df,[k[0] for k in key_pairs])
+    right_keys = block_keys(right_df,[k[1] for k in key_pairs])
+    left_names = left_df[left_col].tolist()
+    right_names = right_df[right_col].tolist()
+
+    left_groups = {}
+    for pos,key in enumerate(left_keys):
+        left_groups.setdefault(key,[]).append(pos)
+    right_groups = {}
+    for pos,key in enumerate(right_keys):
+        right_groups.setdefault(key,[]).append(pos)
+
+    group_keys = list(left_groups.keys())
+    blocks = []
+    for key in group_keys:
+        rpos = right_groups.get(key,[])
+        blocks.append(([left_names[k] for k in left_groups[key]],[right_names[k] for k in rpos]))
+
+    if workers==1 or len(blocks)<2:
+        results = match_blocks(blocks,threshold)
+    else:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        n_chunks = min(workers,len(blocks))
+        chunks = [blocks[k::n_chunks] for k in range(n_chunks)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_results = list(executor.map(match_blocks,chunks,[threshold]*n_chunks))
+        results = [None]*len(blocks)
+        for k in range(n_chunks):
+            results[k::n_chunks] = chunk_results[k]
+
+    right_pos = np.full(len(left_df),-1,dtype=np.int64)
+    scores = np.zeros(len(left_df))
+    methods = ['']*len(left_df)
+    for key,block_result in zip(group_keys,results):
+        rpos = right_groups.get(key,[])
+        for lpos,(pos,score,method) in zip(left_groups[key],block_result):
+            if pos>-1:
+                right_pos[lpos] = rpos[pos]
+            scores[lpos] = score
+            methods[lpos] = method
+
+    right = right_df.reset_index(drop=True).reindex(right_pos)
+    right.columns = [c+suffix if c in left_df.columns else c for c in right.columns]
+    right.index = left_df.index
+    out = pd.concat([left_df,right],axis=1)
+    out['match_score'] = scores
+    out['match_method'] = methods
+    if how=='inner':
+        out = out[right_pos>-1]
+    return out
+
 def fuzzy_in(L,string,threshold=.8,verbose=False):
     # return true if string is fuzzy member of L
 
@@ -61,7 +362,7 @@ def fuzzy_in(L,string,threshold=.8,verbose=False):
     except Exception as e:
         scores = []
         for candidate in L:
-            scores.append(similarity(candidate,string))
+            scores.append(similarity(candidate,string,threshold))
         if np.max(scores)>threshold:
             match = np.argmax(scores)
             winner = L[match]
@@ -99,7 +400,7 @@ def get_matching_name(name,pos,name_list,position_list,match_threshold=0.9,verbo
                     print('%s,%s matches %s,%s (truncation)'%(name,pos,kn,kp))
                 return kn
 
-        sims.append(similarity(knl,name))
+        sims.append(similarity(knl,name,match_threshold))
 
     max_idx = np.argmax(sims)
     max_sim = sims[max_idx]
@@ -113,6 +414,83 @@ def get_matching_name(name,pos,name_list,position_list,match_threshold=0.9,verbo
         return None
 
         
+class NamePositionIndex:
+    # Prepared form of a DataFrame's name and position columns for Matcher: names and
+    # positions lower cased and stripped once, a (name,position) hash map for exact
+    # matches, and rows partitioned by position so that truncation and statistical
+    # matching (same rules as get_matching_name) only scan players at one position.
+
+    def __init__(self,dataframe,name_header,position_header):
+        self.dataframe_ref = weakref.ref(dataframe)
+        self.name_header = name_header
+        self.position_header = position_header
+        self.stamp = frame_stamp(dataframe,[name_header,position_header])
+        self.rows = {}
+        self.exact = {}
+        self.by_position = {}
+        names = dataframe[name_header].tolist()
+        positions = dataframe[position_header].tolist()
+        for row,(kn,kp) in enumerate(zip(names,positions)):
+            if not (type(kn)==str and type(kp)==str):
+                continue
+            self.rows.setdefault((kn,kp),[]).append(row)
+            knl = kn.lower().strip()
+            kpl = kp.lower().strip()
+            if not (knl,kpl) in self.exact:
+                self.exact[(knl,kpl)] = (kn,kp)
+            self.by_position.setdefault(kpl,[]).append((knl,tuple(knl.split()),kn,kp))
+
+    @property
+    def dataframe(self):
+        return self.dataframe_ref()
+
+    def is_current(self,dataframe):
+        return (self.dataframe is dataframe and
+                frame_stamp(dataframe,[self.name_header,self.position_header])==self.stamp)
+
+    def lookup(self,name,pos,threshold=0.9,verbose=False):
+        # returns the (name,position) pair as spelled in the DataFrame, or None
+        name = name.lower().strip()
+        pos = pos.lower().strip()
+        try:
+            winner = self.exact[(name,pos)]
+            if verbose:
+                print('%s,%s matches %s,%s (exact)'%(name,pos,winner[0],winner[1]))
+            return winner
+        except KeyError:
+            pass
+
+        candidates = self.by_position.get(pos,[])
+        name_tokens = tuple(name.split())
+        for knl,tokens,kn,kp in candidates:
+            if not len(tokens)==len(name_tokens):
+                n_terms = min(len(tokens),len(name_tokens))
+                if tokens[:n_terms]==name_tokens[:n_terms]:
+                    if verbose:
+                        print('%s,%s matches %s,%s (truncation)'%(name,pos,kn,kp))
+                    return (kn,kp)
+
+        winner = None
+        max_sim = 0.0
+        for knl,tokens,kn,kp in candidates:
+            sim = similarity(knl,name,threshold)
+            if sim>max_sim:
+                max_sim = sim
+                winner = (kn,kp)
+        if winner is not None and max_sim>=threshold:
+            if verbose:
+                print('%s,%s matches %s,%s (statistical)'%(name,pos,winner[0],winner[1]))
+            return winner
+        if verbose:
+            print('%s,%s is not found'%(name,pos))
+        return None
+
+    def get_rows(self,name,pos,threshold=0.9,verbose=False):
+        winner = self.lookup(name,pos,threshold,verbose)
+        if winner is None:
+            return None
+        return self.dataframe.iloc[self.rows[winner]]
+
 class Matcher:
 
     def __init__(self,whitelist_filename='./mwl.txt'):
@@ -121,6 +499,15 @@ class Matcher:
             self.whitelist = self.file_to_list(self.whitelist_filename,min_items=2)
         except Exception as e:
             self.whitelist = []
+        self.indices = {}
+
+    def get_index(self,dataframe,name_header='name',position_header='pos',rebuild=False):
+        # NamePositionIndex for dataframe, prepared on first use and kept while its
+        # name and position columns are unchanged; rebuild=True after editing their
+        # cells in place
+        return cached_frame_index(self.indices,dataframe,(name_header,position_header),
+                                  lambda: NamePositionIndex(dataframe,name_header,position_header),
+                                  rebuild)
 
     def get_dictionary(self,dataframe,name,position,name_header='name',position_header='pos',threshold=0.85,inquire=True,preserve_case=False,fmt_str='%s|%s',verbose=False):
         series = self.get_series(dataframe,name,position,name_header,position_header,threshold,inquire,preserve_case,fmt_str)
@@ -131,15 +518,8 @@ class Matcher:
         return out
             
     def get_series(self,dataframe,name,position,name_header='name',position_header='pos',threshold=0.85,inquire=True,preserve_case=False,fmt_str='%s|%s',verbose=False):
-        nlist = dataframe[name_header].tolist()
-        plist = dataframe[position_header].tolist()
-        nwinner = get_matching_name(name,position,nlist,plist,verbose=verbose,match_threshold=threshold)
-        if nwinner is None:
-            return None
-        pwinner = plist[nlist.index(nwinner)]
-        prospect = dataframe[(dataframe[name_header]==nwinner)
-                             & (dataframe[position_header]==pwinner)]
-        return prospect
+        index = self.get_index(dataframe,name_header,position_header)
+        return index.get_rows(name,position,threshold=threshold,verbose=verbose)
         
     def get_series_old(self,dataframe,name,position,name_header='name',position_header='pos',threshold=0.85,inquire=True,preserve_case=False,fmt_str='%s|%s'):
         
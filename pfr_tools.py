@@ -1,29 +1,33 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from unicodedata import normalize
-import relish
-from bs4 import BeautifulSoup
-import requests
+from bs4 import SoupStrainer
 import sys,os
-from .tools import Player
+from .tools import Player,PlayerTable
 import importlib.resources as pkg_resources
 from . import data as league_data
-from .scraper import get_soup
+from .scraper import get_soup,get_page,BadResponseException
+from . import fetcher
+from .scoring import score_gamelogs,default_profile
+from io import StringIO
 import re
 import logging
+import threading
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-logging.basicConfig(filename='fantasy_tools.log', level=logging.INFO)
-#logging.getLogger().addHandler(logging.StreamHandler())
+pfr_missing_dict = None
 
+def get_pfr_missing_dict():
+    # {unique_id: pfr_id} for players the other sources miss, read on first use
+    global pfr_missing_dict
+    if pfr_missing_dict is None:
+        with pkg_resources.open_text(league_data, 'pfr_missing.csv') as fid:
+            pfr_missing_df = pd.read_csv(fid)
+        pfr_missing_dict = dict(zip(pfr_missing_df['unique_id'],pfr_missing_df['pfr_id']))
+    return pfr_missing_dict
 
-with pkg_resources.open_text(league_data, 'pfr_missing.csv') as fid:
-    pfr_missing_df = pd.read_csv(fid)
-
-pfr_missing_dict = {}
-for idx,row in pfr_missing_df.iterrows():
-    pfr_missing_dict[row['unique_id']] = row['pfr_id']
-    
 def pfr_id_to_url(pfr_id):
     letter = pfr_id[0].upper()
     url = 'https://www.pro-football-reference.com/players/%s/%s.htm'%(letter,pfr_id)
@@ -35,117 +39,464 @@ def pfr_id_to_gamelog_url(pfr_id,year):
     return url
 
 
-def check_position_mascot(pfr_id,position,mascot,verbose=False,strict=False):
+# parse player pages with lxml if it's available
+try:
+    import lxml
+    page_parser = 'lxml'
+except ImportError:
+    page_parser = 'html.parser'
+
+player_page_facts = {}
+
+def parse_player_page(soup):
+    # the facts we use from a PFR player page: the terms of its 'Pos:' meta
+    # descriptions, and position, throws, height, weight and salary from its <p> tags
+    facts = {'pos_terms':[],'position':'','throws':'','height':np.nan,'weight':np.nan,'salary':np.nan}
+    for meta in soup.find_all('meta'):
+        content = meta.get('content')
+        if content is not None and content.find('Pos:')>-1:
+            facts['pos_terms'].append([k.upper() for k in re.split('\W+',content)])
+
+    for p in soup.find_all('p'):
+        text = p.text
+        if text.find('Position')>-1:
+            try:
+                position = text.strip()[len('Position: '):].replace('\n',' ').replace('  ',' ').strip()
+                if position.find('Throws')>-1:
+                    pos_root = position.split()[0]
+                    if position.find('Right')>-1:
+                        facts['throws'] = 'right'
+                    elif position.find('Left')>-1:
+                        facts['throws'] = 'left'
+                    facts['position'] = pos_root
+                else:
+                    facts['position'] = position
+            except:
+                pass
+        elif text.find('lb')>-1 and text.find(',')>-1:
+            try:
+                temp = text[:text.find('lb')]
+                assert len(temp)>5
+                toks = temp.split()
+                htoks = toks[0].replace(',','').split('-')
+                facts['height'] = float(htoks[0])+float(htoks[1])/12.0
+                facts['weight'] = float(toks[1])
+            except:
+                pass
+        elif text.find('Current salary:')>-1:
+            try:
+                facts['salary'] = float(text[len('Current salary:'):].strip().replace(',',''))
+            except:
+                pass
+    return facts
+
+def get_player_page_facts(pfr_id,verbose=False):
+    # parse_player_page for pfr_id's page, parsed once per process; only the
+    # <meta> and <p> tags are parsed. Raises if the page can't be fetched.
     url = pfr_id_to_url(pfr_id)
     try:
-        soup = get_soup(url,verbose=verbose)
-        metas = soup.findAll('meta')
-        for k in range(len(metas)):
-            meta = metas.pop(0)
-            content = meta.get('content')
-            if content is not None:
-                if content.find('Pos:')>-1:
-                    term_list = [k.upper() for k in re.split('\W+',content)]
-                    if verbose:
-                        print(position.upper(),mascot.upper(),term_list)
-                    if position.upper() in term_list:
-                        if (not strict) or (mascot.upper() in term_list):
-                                return True
+        return player_page_facts[url]
+    except KeyError:
+        soup = get_soup(url,verbose=verbose,parser=page_parser,parse_only=SoupStrainer(['meta','p']))
+        facts = parse_player_page(soup)
+        player_page_facts[url] = facts
+        return facts
+
+def check_position_mascot(pfr_id,position,mascot,verbose=False,strict=False):
+    try:
+        facts = get_player_page_facts(pfr_id,verbose=verbose)
+        for term_list in facts['pos_terms']:
+            if verbose:
+                print(position.upper(),mascot.upper(),term_list)
+            if position.upper() in term_list:
+                if (not strict) or (mascot.upper() in term_list):
+                        return True
     except:
         return False
     return False
 
     
-def gamelog_to_fpts(df,position,name):
-    #print(position)
-    requirements = {'QB':['Passing_Cmp','Passing_Yds','Passing_TD','Passing_Int'],
-                    'RB':['Rushing_Yds','Rushing_TD'],
-                    'WR':['Receiving_Rec','Receiving_Yds','Receiving_TD'],
-                    'TE':['Receiving_Rec','Receiving_Yds','Receiving_TD']}
-
-    cols = df.columns
-    for req in requirements[position]:
+def gamelog_to_fpts(df,position=None,name=None,profile=default_profile):
+    # fantasy points for each game in df under a scoring profile (see scoring);
+    # stats missing from df count as zero, and games with no stats at all are NaN
+    return pd.Series(score_gamelogs(df,[profile])[:,0],index=df.index)
+
+
+# Season-wide gamelogs: every player's weekly stats for a season in one table,
+# so per-player gamelogs become slices of it. The table comes from nflverse's
+# weekly player stats (one file per season), a local dump, or PFR's box scores
+
+boxscore_columns = {'pass_cmp':'Passing_Cmp','pass_att':'Passing_Att','pass_yds':'Passing_Yds',
+                    'pass_td':'Passing_TD','pass_int':'Passing_Int','pass_sacked':'Passing_Sk',
+                    'pass_sacked_yds':'Passing_Yds.1','pass_rating':'Passing_Rate',
+                    'rush_att':'Rushing_Att','rush_yds':'Rushing_Yds','rush_td':'Rushing_TD',
+                    'targets':'Receiving_Tgt','rec':'Receiving_Rec','rec_yds':'Receiving_Yds',
+                    'rec_td':'Receiving_TD','fumbles':'Fumbles_Fmb','fumbles_lost':'Fumbles_FL'}
+
+# nflverse's weekly player stats, one csv per season, keyed by gsis_id; the
+# DynastyProcess id table maps gsis_ids to pfr_ids
+nflverse_weekly_url = 'https://github.com/nflverse/nflverse-data/releases/download/player_stats/player_stats_%d.csv'
+player_ids_url = 'https://raw.githubusercontent.com/dynastyprocess/data/master/files/db_playerids.csv'
+
+# nflverse stat columns as gamelog columns; some were renamed between releases
+nflverse_columns = {'completions':'Passing_Cmp','attempts':'Passing_Att','passing_yards':'Passing_Yds',
+                    'passing_tds':'Passing_TD','interceptions':'Passing_Int','passing_interceptions':'Passing_Int',
+                    'sacks':'Passing_Sk','sacks_suffered':'Passing_Sk','sack_yards':'Passing_Yds.1',
+                    'sack_yards_lost':'Passing_Yds.1','carries':'Rushing_Att','rushing_yards':'Rushing_Yds',
+                    'rushing_tds':'Rushing_TD','targets':'Receiving_Tgt','receptions':'Receiving_Rec',
+                    'receiving_yards':'Receiving_Yds','receiving_tds':'Receiving_TD'}
+
+# nflverse team abbreviations that differ from gamelogs' Tm
+nflverse_team_abbreviations = {'GB':'GNB','KC':'KAN','NE':'NWE','NO':'NOR','SF':'SFO','TB':'TAM',
+                               'LV':'LVR','LA':'LAR','SD':'SDG'}
+
+season_gamelogs = {}
+
+from .gamelog_store import conform_gamelog
+try:
+    from .gamelog_store import GamelogStore
+    gamelog_store = GamelogStore()
+except ImportError:
+    # without pyarrow, gamelogs are cached as one csv per player-season
+    gamelog_store = None
+
+def season_games_url(year):
+    return 'https://www.pro-football-reference.com/years/%d/games.htm'%year
+
+# PFR's team pages (/teams/<code>/) use franchise codes, which differ from the
+# team abbreviations in gamelogs' Tm column for these franchises; relocated ones
+# map to (abbreviation before the move, last season there, abbreviation after)
+franchise_abbreviations = {'CRD':'ARI','RAV':'BAL','HTX':'HOU','CLT':'IND','OTI':'TEN',
+                           'RAI':('OAK',2019,'LVR'),'SDG':('SDG',2016,'LAC'),'RAM':('STL',2015,'LAR')}
+
+def franchise_to_abbreviation(code,year):
+    # gamelog Tm abbreviation for a franchise code from a team page url
+    abbreviation = franchise_abbreviations.get(code,code)
+    if type(abbreviation)==tuple:
+        before,last_year,after = abbreviation
+        if year<=last_year:
+            return before
+        return after
+    return abbreviation
+
+def get_season_schedule(year,verbose=False,max_age=None):
+    # one dictionary per regular season game played so far in year, with its week,
+    # date, boxscore url and the abbreviations of its teams (as in gamelogs' Tm);
+    # max_age (seconds) forces a fresh copy of the schedule page in-season
+    soup = get_soup(season_games_url(year),verbose=verbose,parser=page_parser,parse_only=SoupStrainer('table',id='games'),max_age=max_age)
+    games = []
+    for tr in soup.find_all('tr'):
+        week = tr.find(attrs={'data-stat':'week_num'})
+        link = tr.find(attrs={'data-stat':'boxscore_word'})
+        if week is None or link is None or link.find('a') is None:
+            continue
+        if not link.text.strip()=='boxscore':
+            # games not played yet link to a preview
+            continue
         try:
-            assert req in cols
-        except AssertionError:
-            print(name)
-            print(position)
-            print(cols)
-            print(req)
-            return 0.0
-            
-    scoring_rules = [('Passing_Cmp',0.1), ('Passing_Yds',0.04), ('Passing_TD',4.0), ('Passing_Int',(-2)), ('Rushing_Yds',0.1), ('Rushing_TD',6.0), ('Receiving_Rec',0.5), ('Receiving_Yds',0.1), ('Receiving_TD',6.0), ('Fumbles_Fmb',(-2))]
-    pts = 0.0
-    for rule in scoring_rules:
+            week = int(week.text)
+        except ValueError:
+            # playoff games are labeled WildCard, Division, etc.
+            continue
+        teams = []
+        for stat in ['winner','loser']:
+            cell = tr.find(attrs={'data-stat':stat})
+            if cell is not None and cell.find('a') is not None:
+                teams.append(franchise_to_abbreviation(cell.find('a')['href'].split('/')[2].upper(),year))
+        date = tr.find(attrs={'data-stat':'game_date'})
+        if date is not None:
+            date = date.text.strip()
+        games.append({'week':week,'date':date,'url':'https://www.pro-football-reference.com'+link.find('a')['href'],'teams':teams})
+    return games
+
+def get_season_games(year,verbose=False):
+    # (week,boxscore url) for each regular season game played so far in year
+    return [(g['week'],g['url']) for g in get_season_schedule(year,verbose=verbose)]
+
+def parse_boxscore_offense(soup):
+    # one record per player in a box score's player_offense table
+    records = []
+    for tr in soup.find_all('tr'):
+        th = tr.find('th',attrs={'data-stat':'player'})
+        if th is None or not th.has_attr('data-append-csv'):
+            continue
+        record = {'pfr_id':th['data-append-csv'],'Player':th.text.strip()}
+        for td in tr.find_all('td'):
+            stat = td.get('data-stat')
+            if stat=='team':
+                record['Tm'] = td.text.strip()
+            elif stat in boxscore_columns:
+                try:
+                    record[boxscore_columns[stat]] = float(td.text)
+                except ValueError:
+                    record[boxscore_columns[stat]] = np.nan
+        records.append(record)
+    return records
+
+def get_boxscore_offense(url,verbose=False):
+    soup = get_soup(url,verbose=verbose,parser=page_parser,parse_only=SoupStrainer('table',id='player_offense'))
+    return parse_boxscore_offense(soup)
+
+player_ids = None
+
+def get_player_ids(max_age=None):
+    # {gsis_id: pfr_id} from the DynastyProcess id table, fetched on first use
+    global player_ids
+    if player_ids is None or max_age is not None:
+        df = pd.read_csv(StringIO(get_page(player_ids_url,max_age=max_age)),usecols=['gsis_id','pfr_id'])
+        df = df.dropna()
+        player_ids = dict(zip(df['gsis_id'],df['pfr_id']))
+    return player_ids
+
+def nflverse_to_gamelog(df):
+    # an nflverse weekly player stats table (regular season rows only) in gamelog
+    # columns, with pfr_ids in place of gsis_ids; players with no known pfr_id are dropped
+    if 'season_type' in df.columns:
+        df = df[df['season_type']=='REG']
+    out = pd.DataFrame({'pfr_id':df['player_id'].map(get_player_ids()).values})
+    if 'player_display_name' in df.columns:
+        out['Player'] = df['player_display_name'].values
+    else:
+        out['Player'] = df['player_name'].values
+    for team_column,column in [('recent_team','Tm'),('team','Tm'),('opponent_team','Opp')]:
+        if team_column in df.columns:
+            out[column] = df[team_column].replace(nflverse_team_abbreviations).values
+    out['Week'] = df['week'].values
+    for nflverse_column,column in nflverse_columns.items():
+        if nflverse_column in df.columns:
+            out[column] = df[nflverse_column].values
+    fumbles = [c for c in df.columns if c.endswith('_fumbles')]
+    fumbles_lost = [c for c in df.columns if c.endswith('_fumbles_lost')]
+    out['Fumbles_Fmb'] = df[fumbles].fillna(0).sum(axis=1).values
+    out['Fumbles_FL'] = df[fumbles_lost].fillna(0).sum(axis=1).values
+    missing = out['pfr_id'].isna()
+    if missing.any():
+        logging.info('Dropped %d player-games with no known pfr_id.'%missing.sum())
+    return out[~missing]
+
+def get_boxscore_gamelogs(year,workers=4,verbose=False):
+    # a season's player-games from PFR: the schedule page plus one box score per
+    # game played, about 270 requests for a full season
+    games = get_season_schedule(year,verbose=verbose)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda g: get_boxscore_offense(g['url'],verbose),games))
+    records = []
+    for game,game_records in zip(games,results):
+        for record in game_records:
+            record['Week'] = game['week']
+            record['Date'] = game['date']
+            opponents = [t for t in game['teams'] if not t==record.get('Tm')]
+            if len(opponents)==1:
+                record['Opp'] = opponents[0]
+            records.append(record)
+    logging.info('Loaded %d player-games for %d from %d box scores.'%(len(records),year,len(games)))
+    df = pd.DataFrame(records)
+    # a blank in a box score means the player had none of that stat
+    for col in boxscore_columns.values():
+        if col in df.columns:
+            df[col] = df[col].astype(np.float64).fillna(0.0)
+    return df
+
+def load_season_gamelogs(year,dump_filename=None,workers=4,verbose=False,source='nflverse',max_age=None):
+    # Every player's weekly stats for year in one table, in the same columns and
+    # types as any other gamelog (see gamelog_store.conform_gamelog), indexed by
+    # pfr_id and sorted by pfr_id and Week, with fpts computed. Sources:
+    #   dump_filename: a local .csv or .parquet, either in gamelog columns (with
+    #     pfr_id and Week) or an nflverse weekly player stats file; nothing is fetched
+    #   source='nflverse': nflverse's weekly player stats file for year, one request
+    #     (plus the id table, once); max_age (seconds) refetches it in-season
+    #   source='boxscores': PFR's box scores, about 270 requests a season, more than
+    #     fetching one league's players' gamelogs one at a time
+    # Rk and G# number each player's games in the table, and the sources have no
+    # Age, Result or GS. The table is kept in season_gamelogs, where
+    # get_player_gamelog looks first.
+    if dump_filename is not None:
+        if dump_filename.endswith('.parquet'):
+            df = pd.read_parquet(dump_filename)
+        else:
+            df = pd.read_csv(dump_filename)
+        if 'player_id' in df.columns and 'week' in df.columns:
+            df = nflverse_to_gamelog(df)
+    elif source=='nflverse':
+        df = nflverse_to_gamelog(pd.read_csv(StringIO(get_page(nflverse_weekly_url%year,max_age=max_age)),low_memory=False))
+        logging.info('Loaded %d player-games for %d from nflverse.'%(len(df),year))
+    elif source=='boxscores':
+        df = get_boxscore_gamelogs(year,workers=workers,verbose=verbose)
+    else:
+        raise ValueError('Unknown gamelog source %s.'%source)
+
+    df = conform_gamelog(df).sort_values(['pfr_id','Week'],kind='stable').reset_index(drop=True)
+    games = df.groupby('pfr_id').cumcount().values+1
+    df['Rk'] = pd.array(games,dtype='Int16')
+    df['G#'] = pd.array(games,dtype='Int16')
+    df['fpts'] = gamelog_to_fpts(df).values
+    df = df.set_index('pfr_id',drop=False)
+    df.index.name = None
+    season_gamelogs[year] = df
+    return df
+
+def season_gamelog_slice(pfr_id,year):
+    # in-memory gamelog of one player from a loaded season table, or None if the
+    # season hasn't been loaded
+    try:
+        table = season_gamelogs[year]
+    except KeyError:
+        return None
+    try:
+        return table.loc[[pfr_id]].reset_index(drop=True)
+    except KeyError:
+        return pd.DataFrame([])
+
+
+    
+def fetch_player_gamelog(player,year,verbose=False,score=True):
+    # player's regular season gamelog for year from PFR, with fpts unless score is
+    # False; None if unavailable
+    pfr_id = player.pfr_id
+    try:
+        url = pfr_id_to_gamelog_url(pfr_id,year)
+        response = fetcher.get(url)
+        assert response.status_code==200
+        dfs = pd.read_html(StringIO(response.text))
+        if verbose:
+            logging.info('Getting %s log from %s.'%(player.name,url))
+    except:
+        return None
+
+    # if there are multiple tables, the first one is regular season and the second is playoffs--ignore the latter
+    df = dfs[0]
+
+    new_columns = []
+
+    for col in df.columns:
+        if col[0].find('Unnamed')>-1:
+            new_columns.append(col[1])
+        else:
+            new_columns.append('%s_%s'%(col[0],col[1]))
+
+    df.columns = new_columns
+
+    df = df[:-1]
+    zero_strings = ['Inactive','Injured Reserve','Did Not Play','COVID-19 List','Suspended','Exempt List']
+    for zs in zero_strings:
+        df = df.replace(zs,np.nan)
+
+
+    for col in ['Rk', 'G#', 'Week', 'Age', 'Passing_Cmp', 'Passing_Att',
+                'Passing_Yds', 'Passing_TD', 'Passing_Int', 'Passing_Rate',
+                'Passing_Sk', 'Passing_Yds.1', 'Passing_Y/A', 'Passing_AY/A',
+                'Rushing_Att', 'Rushing_Yds', 'Rushing_Y/A', 'Rushing_TD', 'Scoring_TD',
+                'Scoring_Pts', 'Fumbles_Fmb', 'Fumbles_FL', 'Fumbles_FF', 'Fumbles_FR',
+                'Fumbles_Yds', 'Fumbles_TD', 'Off. Snaps_Num']:
         try:
-            pts = pts + df[rule[0]]*rule[1]
-        except Exception as e:
+            df[col] = df[col].astype(np.float64)
+        except KeyError:
             pass
-            
-    return pts
 
+    if score:
+        df['fpts'] = gamelog_to_fpts(df,player.position,player.name)
+    return df
 
-    
 def get_player_gamelog(player,year,verbose=False):
+    # From a loaded season table if there is one, then gamelog_store (or, without
+    # pyarrow, one csv per player-season in ./.gamelogs), then PFR. Whichever it
+    # comes from, the gamelog is in the columns and types of conform_gamelog.
     try:
         pfr_id = player.pfr_id
         
         if pfr_id=='NoId':
             return pd.DataFrame([])
-        
+
+        df = season_gamelog_slice(pfr_id,year)
+        if df is not None:
+            return df
+
+        if gamelog_store is not None and gamelog_store.has_player(year,pfr_id):
+            if verbose:
+                logging.info('Getting %s log from gamelog store.'%player.name)
+            return gamelog_store.read(year,pfr_ids=[pfr_id])
+
         csv_cache = './.gamelogs'
-        os.makedirs(csv_cache,exist_ok=True)
         cache_fn = os.path.join(csv_cache,'pfr_gamelog_%s_%d.csv'%(pfr_id,year))
         try:
+            # also how gamelogs cached before gamelog_store get migrated into it
             df = pd.read_csv(cache_fn)
             if verbose:
                 logging.info('Getting %s log from %s.'%(player.name,cache_fn))
         except:
-            try:
-                url = pfr_id_to_gamelog_url(pfr_id,year)
-                dfs = pd.read_html(url)
-                if verbose:
-                    logging.info('Getting %s log from %s.'%(player.name,url))
-            except:
+            df = fetch_player_gamelog(player,year,verbose=verbose)
+            if df is None:
                 return pd.DataFrame([])
+            if gamelog_store is None:
+                os.makedirs(csv_cache,exist_ok=True)
+                df.to_csv(cache_fn)
 
-            # if there are multiple tables, the first one is regular season and the second is playoffs--ignore the latter
-            df = dfs[0]
+        if gamelog_store is not None:
+            gamelog_store.write(df,year,pfr_id)
+            df = gamelog_store.read(year,pfr_ids=[pfr_id])
+        else:
+            df = conform_gamelog(df.assign(pfr_id=pfr_id))
+            
+    except KeyError:
+        df = pd.DataFrame([])
+    return df
 
-            new_columns = []
+def get_player_gamelogs(players,year,verbose=False):
+    # {pfr_id: gamelog} for many players: read from gamelog_store in one pass (unless
+    # the season table is loaded), with only the players it doesn't have going
+    # through get_player_gamelog one at a time
+    pfr_ids = [p.pfr_id for p in players if type(p.pfr_id)==str and not p.pfr_id=='NoId']
+    out = {}
+    if gamelog_store is not None and not year in season_gamelogs:
+        out = gamelog_store.read_players(year,pfr_ids)
+    for p in players:
+        if p.pfr_id in pfr_ids and not p.pfr_id in out:
+            out[p.pfr_id] = get_player_gamelog(p,year,verbose=verbose)
+    return out
 
-            for col in df.columns:
-                if col[0].find('Unnamed')>-1:
-                    new_columns.append(col[1])
-                else:
-                    new_columns.append('%s_%s'%(col[0],col[1]))
+def refresh_gamelogs(players,year,max_age=3600,workers=4,verbose=False):
+    # In-season update of gamelog_store: only players whose team has completed a
+    # game after the last week stored for them (or who have nothing stored) are
+    # fetched, and only the new weeks are scored and appended. The schedule is
+    # refetched if the stored copy is older than max_age seconds. Returns
+    # {pfr_id: number of new weeks} for the players fetched.
+    if gamelog_store is None:
+        raise ImportError('refresh_gamelogs needs pyarrow for gamelog_store.')
 
-            df.columns = new_columns
+    team_last_week = {}
+    for game in get_season_schedule(year,verbose=verbose,max_age=max_age):
+        for team in game['teams']:
+            team_last_week[team] = max(team_last_week.get(team,0),game['week'])
 
-            df = df[:-1]
-            zero_strings = ['Inactive','Injured Reserve','Did Not Play','COVID-19 List','Suspended','Exempt List']
-            for zs in zero_strings:
-                df = df.replace(zs,np.nan)
+    last_weeks = gamelog_store.last_weeks(year)
+    stale = []
+    for p in players:
+        pfr_id = p.pfr_id
+        if not (type(pfr_id)==str and len(pfr_id)>4) or pfr_id=='NoId':
+            continue
+        try:
+            last_week,team = last_weeks[pfr_id]
+        except KeyError:
+            stale.append((p,0))
+            continue
+        if team_last_week.get(team,np.inf)>last_week:
+            stale.append((p,last_week))
+    logging.info('Refreshing %d of %d gamelogs for %d.'%(len(stale),len(players),year))
 
+    def refresh(item):
+        p,last_week = item
+        df = fetch_player_gamelog(p,year,verbose=verbose,score=False)
+        if df is None:
+            return p.pfr_id,0
+        df = df[pd.to_numeric(df['Week'],errors='coerce')>last_week].copy()
+        if len(df):
+            df['fpts'] = gamelog_to_fpts(df,p.position,p.name)
+            gamelog_store.write(df,year,p.pfr_id)
+        return p.pfr_id,len(df)
 
-            for col in ['Rk', 'G#', 'Week', 'Age', 'Passing_Cmp', 'Passing_Att',
-                        'Passing_Yds', 'Passing_TD', 'Passing_Int', 'Passing_Rate',
-                        'Passing_Sk', 'Passing_Yds.1', 'Passing_Y/A', 'Passing_AY/A',
-                        'Rushing_Att', 'Rushing_Yds', 'Rushing_Y/A', 'Rushing_TD', 'Scoring_TD',
-                        'Scoring_Pts', 'Fumbles_Fmb', 'Fumbles_FL', 'Fumbles_FF', 'Fumbles_FR',
-                        'Fumbles_Yds', 'Fumbles_TD', 'Off. Snaps_Num']:
-                try:
-                    df[col] = df[col].astype(np.float64)
-                except KeyError:
-                    pass
-
-            fpts = gamelog_to_fpts(df,player.position,player.name)
-            df['fpts'] = fpts
-            df.to_csv(cache_fn)
-            
-    except KeyError:
-        df = pd.DataFrame([])
-    return df
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        out = dict(executor.map(refresh,stale))
+    return out
 
 
 class Attributes:
@@ -166,80 +517,129 @@ class Attributes:
         except Exception as e:
             return '%s: no PFR attributes'%self.name
 
-def get_player_attributes(player,verbose=False):
-    
-    pfr_id = player.pfr_id
+class AttributeStore:
+    # One sqlite table of player attributes scraped from PFR player pages, keyed by
+    # pfr_id, loaded into memory on first use. Pages that couldn't be fetched are
+    # stored too (found=0), so failed lookups aren't retried until they're stale.
+
+    columns = ['position','throws','height','weight','salary']
+
+    def __init__(self,filename='./.attributes/attributes.sqlite',max_age=30*24*3600,max_age_missing=7*24*3600):
+        self.filename = filename
+        self.max_age = max_age
+        self.max_age_missing = max_age_missing
+        self.connection = None
+        self.rows = None
+        self.lock = threading.Lock()
 
-    relish_tag = '%s_attributes'%player.unique_id
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.filename),exist_ok=True)
+            self.connection = sqlite3.connect(self.filename,check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS attributes (pfr_id TEXT PRIMARY KEY, position TEXT, throws TEXT, height REAL, weight REAL, salary REAL, found INTEGER, fetched_at REAL)')
+            self.rows = {}
+            for row in self.connection.execute('SELECT * FROM attributes'):
+                self.rows[row[0]] = dict(zip(self.columns+['found','fetched_at'],row[1:]))
+        return self.connection
 
+    def get(self,pfr_id):
+        # the stored row for pfr_id, or None if there's none or it's stale
+        with self.lock:
+            self.connect()
+            row = self.rows.get(pfr_id)
+        if row is None:
+            return None
+        if row['found']:
+            max_age = self.max_age
+        else:
+            max_age = self.max_age_missing
+        if time.time()-row['fetched_at']>max_age:
+            return None
+        return row
+
+    def put_many(self,rows):
+        # rows maps pfr_id to a dictionary with columns and found
+        now = time.time()
+        with self.lock:
+            con = self.connect()
+            with con:
+                for pfr_id,row in rows.items():
+                    row = dict(row)
+                    row['fetched_at'] = now
+                    # sqlite stores NaN as NULL
+                    values = [None if (type(row[c])==float and np.isnan(row[c])) else row[c] for c in self.columns]
+                    con.execute('INSERT OR REPLACE INTO attributes VALUES (?,?,?,?,?,?,?,?)',
+                                [pfr_id]+values+[int(row['found']),now])
+                    self.rows[pfr_id] = row
+
+    def to_dataframe(self):
+        with self.lock:
+            self.connect()
+            return pd.DataFrame.from_dict(self.rows,orient='index')
+
+attribute_store = AttributeStore()
+
+def valid_pfr_id(pfr_id):
+    return type(pfr_id)==str and len(pfr_id)>0 and not pfr_id=='NoId'
+
+def fetch_attributes(pfr_id,verbose=False):
+    # attribute row for pfr_id, a not-found row if PFR has no such page, or None if
+    # the page couldn't be fetched this time (throttled, server or network error)
     try:
-        att = relish.load(relish_tag)
-    except:
-        
-        att = Attributes(player.name)
-        
-        if pfr_id=='NoId':
-            return att
-        
-        try:
-            url = pfr_id_to_url(pfr_id)
-        except:
-            # if the pfr_id is empty or nan
-            return att
+        facts = get_player_page_facts(pfr_id,verbose=verbose)
+    except BadResponseException as e:
+        if not e.status==404:
+            logging.warning('Could not fetch attributes for %s: %s'%(pfr_id,e))
+            return None
+        if verbose:
+            logging.info('No attributes for %s: %s'%(pfr_id,e))
+        return {'position':'','throws':'','height':np.nan,'weight':np.nan,'salary':np.nan,'found':False}
+    except Exception as e:
+        logging.warning('Could not fetch attributes for %s: %s'%(pfr_id,e))
+        return None
+    row = dict([(c,facts[c]) for c in AttributeStore.columns])
+    row['found'] = True
+    return row
 
+def get_attributes(players,workers=4,verbose=False):
+    # Attributes for each of players (a list of Players or a PlayerTable), in
+    # order. Only pfr_ids missing from attribute_store (or stale there) are
+    # fetched, concurrently, and written back in one go; players without a
+    # pfr_id get empty Attributes.
+    if isinstance(players,PlayerTable):
+        names,pfr_ids = players.name,players.pfr_id
+    else:
+        names = [p.name for p in players]
+        pfr_ids = [p.pfr_id for p in players]
 
-        soup = get_soup(url,verbose=verbose)
-        ps = soup.findAll('p')
-        scanning_for_hs = False
-        scanning_for_college = False
-        
-        for k in range(len(ps)):
-            text = ps[k].text
-            if text.find('Position')>-1:
-                try:
-                    position = text.strip()[len('Position: '):].replace('\n',' ').replace('  ',' ').strip()
-                    if position.find('Throws')>-1:
-                        pos_root = position.split()[0]
-                        if position.find('Right')>-1:
-                            att.throws = 'right'
-                        elif position.find('Left')>-1:
-                            att.throws = 'left'
-                        att.position = pos_root
-                    else:
-                        att.position = position
-                except:
-                    pass
-            elif text.find('lb')>-1 and text.find(',')>-1:
-                try:
-                    temp = text[:text.find('lb')]
-                    assert len(temp)>5
-                    toks = temp.split()
-                    htoks = toks[0].replace(',','').split('-')
-                    height = float(htoks[0])+float(htoks[1])/12.0
-                    weight = float(toks[1])
-                    att.height = height
-                    att.weight = weight
-                except:
-                    pass
-            elif text.find('Current salary:')>-1:
-                try:
-                    att.salary = float(text[len('Current salary:'):].strip().replace(',',''))
-                except:
-                    pass
-            # elif text.find('College:')>-1:
-            #     scanning_for_college = True
-            # elif text.find('High school:')>-1:
-            #     scanning_for_hs = True
-
-            # if scanning_for_college:
-            #     print(text)
-            #     if len(text)>3:
-            #         att.college = text.strip()
-            #         scanning_for_college = False
-
-            # if scanning_for_hs:
-            #     if len(text)>3:
-            #         att.hs = text.strip()
-            #         scanning_for_hs = False
-        relish.save(relish_tag,att)
-    return att
+    rows = {}
+    missing = []
+    for pfr_id in pfr_ids:
+        if not valid_pfr_id(pfr_id) or pfr_id in rows:
+            continue
+        row = attribute_store.get(pfr_id)
+        rows[pfr_id] = row
+        if row is None:
+            missing.append(pfr_id)
+
+    if len(missing):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = dict(zip(missing,executor.map(lambda pfr_id: fetch_attributes(pfr_id,verbose),missing)))
+        # failed fetches aren't stored, so they're retried next time
+        attribute_store.put_many(dict([(pfr_id,row) for pfr_id,row in fetched.items() if row is not None]))
+        rows.update(fetched)
+
+    out = []
+    for name,pfr_id in zip(names,pfr_ids):
+        att = Attributes(name)
+        row = rows.get(pfr_id) if valid_pfr_id(pfr_id) else None
+        if row is not None:
+            for c in AttributeStore.columns:
+                if row[c] is None:
+                    continue
+                setattr(att,c,row[c])
+        out.append(att)
+    return out
+
+def get_player_attributes(player,verbose=False):
+    return get_attributes([player],verbose=verbose)[0]
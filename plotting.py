@@ -1,5 +1,5 @@
-from . import build_league,build_player_table,position_color_dict,posrank_split
-from .pfr_tools import get_player_gamelog
+from . import build_league,build_player_table,position_color_dict
+from .pfr_tools import get_player_gamelog,get_attributes
 import sys,os,glob
 from matplotlib import pyplot as plt
 import numpy as np
@@ -11,8 +11,14 @@ markersize = 5
 
 def make_attribute_plot(player_set,func1,func2,marker='ko',title=None,ylim=None,xlim=None,verbose=False,plotfunc=plt.plot):
 
+    # player_set can be a list of Players or a PlayerTable
+
     fig = plt.figure(figsize=default_figsize)
 
+    # fetch any attributes not yet in the attribute table in one batch, so that
+    # func1 and func2 (which usually call get_player_attributes) read from it
+    get_attributes(player_set,verbose=verbose)
+
     xvec = []
     yvec = []
     for p in player_set:
@@ -56,10 +62,15 @@ def make_attribute_plot(player_set,func1,func2,marker='ko',title=None,ylim=None,
     plt.savefig(out_fn)
 
 
-def make_league_plot(league,rookie_year,func,description='generic',mode='keepers',ylim=(None,None),ytickfmt='%0.1f',verbose=False,plotfunc=plt.plot):
+def make_league_plot(league,rookie_year,func,description='generic',mode='keepers',ylim=(None,None),ytickfmt='%0.1f',verbose=False,plotfunc=plt.plot,keepers=None):
 
     # func must be a function that takes a player and returns a single, plottable value
     # mode can be 'keepers' or 'players'
+    # keepers is an optional team->keepers dictionary from league.compute_keepers, to
+    # share one keeper computation between several plots
+
+    if mode=='keepers' and keepers is None:
+        keepers = league.compute_keepers(rookie_year)
     
     xticklabels = []
     n_teams = len(league.teams)
@@ -87,7 +98,7 @@ def make_league_plot(league,rookie_year,func,description='generic',mode='keepers
     for idx,team in enumerate(league.teams):
 
         if mode=='keepers':
-            players = team.get_keepers(rookie_year=rookie_year)
+            players = keepers[team]
         elif mode=='players':
             players = team.players
         else:
@@ -100,8 +111,6 @@ def make_league_plot(league,rookie_year,func,description='generic',mode='keepers
             r = func(k,verbose=verbose)
             if r is None:
                 continue
-            posrank = k.posrank
-            p,pr = posrank_split(posrank)
             if k.draft_year==rookie_year:
                 markeredgecolor = 'k'
             else:
@@ -121,7 +130,7 @@ def make_league_plot(league,rookie_year,func,description='generic',mode='keepers
             except TypeError:
                 pass
 
-            plotfunc(idx+shifts[p]*.15,r,'%s%s'%(position_color_dict[k.position],marker),markersize=markersize,markeredgecolor=markeredgecolor,markeredgewidth=markeredgewidth)
+            plotfunc(idx+shifts.get(k.position,0)*.15,r,'%s%s'%(position_color_dict[k.position],marker),markersize=markersize,markeredgecolor=markeredgecolor,markeredgewidth=markeredgewidth)
         xticklabels.append(team.team_abbr)
 
     for k in ['QB','RB','WR','TE']:
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+# Fantasy scoring profiles. Each has per-unit 'weights' for gamelog stat columns
+# and optional 'bonuses', (column,threshold,points) awarded when a game's stat
+# reaches the threshold. A set of profiles compiles to a weight matrix, so a
+# whole table of player-games is scored under all of them with one matrix
+# product and can be rescored later without refetching or reparsing anything.
+
+base_weights = {'Passing_Yds':0.04,'Passing_TD':4.0,'Passing_Int':-2.0,
+                'Rushing_Yds':0.1,'Rushing_TD':6.0,
+                'Receiving_Yds':0.1,'Receiving_TD':6.0,
+                'Fumbles_FL':-2.0}
+
+def make_profile(weights,bonuses=(),**changes):
+    # copy of weights with changes applied, e.g. make_profile(base_weights,Receiving_Rec=1.0)
+    weights = dict(weights)
+    weights.update(changes)
+    return {'weights':weights,'bonuses':list(bonuses)}
+
+scoring_profiles = {'standard':make_profile(base_weights),
+                    'half_ppr':make_profile(base_weights,Receiving_Rec=0.5),
+                    'ppr':make_profile(base_weights,Receiving_Rec=1.0),
+                    # our league: half PPR, 0.1 per completion, -2 for any fumble
+                    'league':{'weights':{'Passing_Cmp':0.1,'Passing_Yds':0.04,'Passing_TD':4.0,'Passing_Int':-2.0,
+                                         'Rushing_Yds':0.1,'Rushing_TD':6.0,
+                                         'Receiving_Rec':0.5,'Receiving_Yds':0.1,'Receiving_TD':6.0,
+                                         'Fumbles_Fmb':-2.0},
+                              'bonuses':[]}}
+
+default_profile = 'league'
+
+def get_profile(profile):
+    # profile can be the name of one in scoring_profiles or a profile dictionary
+    if type(profile)==str:
+        return scoring_profiles[profile]
+    return profile
+
+def compile_profiles(profiles):
+    # (stat columns, weight matrix (columns x profiles), bonus columns and
+    # thresholds, bonus matrix (bonuses x profiles)) for a list of profiles
+    profiles = [get_profile(p) for p in profiles]
+    columns = []
+    bonus_keys = []
+    for p in profiles:
+        for col in p['weights']:
+            if not col in columns:
+                columns.append(col)
+        for col,threshold,points in p['bonuses']:
+            if not (col,threshold) in bonus_keys:
+                bonus_keys.append((col,threshold))
+    weights = np.zeros((len(columns),len(profiles)))
+    bonus_weights = np.zeros((len(bonus_keys),len(profiles)))
+    for k,p in enumerate(profiles):
+        for col,w in p['weights'].items():
+            weights[columns.index(col),k] = w
+        for col,threshold,points in p['bonuses']:
+            bonus_weights[bonus_keys.index((col,threshold)),k]+=points
+    return columns,weights,bonus_keys,bonus_weights
+
+def stat_matrix(df,columns):
+    # df's columns as a float array, with missing columns and NaNs as zeros, and
+    # a mask of rows that have any stat at all (the others are games not played)
+    X = np.zeros((len(df),len(columns)))
+    played = np.zeros(len(df),dtype=bool)
+    for k,col in enumerate(columns):
+        if col in df.columns:
+            values = pd.to_numeric(df[col],errors='coerce').to_numpy(dtype=np.float64)
+            present = ~np.isnan(values)
+            played|=present
+            X[present,k] = values[present]
+    return X,played
+
+def score_gamelogs(df,profiles=(default_profile,)):
+    # fantasy points for every row of df under each profile, as an array of
+    # shape (rows,profiles); rows with no stats at all score NaN
+    columns,weights,bonus_keys,bonus_weights = compile_profiles(profiles)
+    stat_columns = columns+[col for col,threshold in bonus_keys if not col in columns]
+    X,played = stat_matrix(df,stat_columns)
+    pts = X[:,:len(columns)].dot(weights)
+    if len(bonus_keys):
+        thresholds = np.array([threshold for col,threshold in bonus_keys])
+        B = X[:,[stat_columns.index(col) for col,threshold in bonus_keys]]>=thresholds
+        pts = pts+B.dot(bonus_weights)
+    pts[~played,:] = np.nan
+    return pts
+
+def rescore(df,profiles=('standard','half_ppr','ppr')):
+    # copy of df with an fpts_<name> column for each named profile
+    pts = score_gamelogs(df,profiles)
+    df = df.copy()
+    for k,name in enumerate(profiles):
+        df['fpts_%s'%name] = pts[:,k]
+    return df
@@ -1,46 +1,147 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from unicodedata import normalize
-import relish
 from bs4 import BeautifulSoup
-import requests
-import sys
+import sys,os
+import json
+import zlib
+import sqlite3
+import hashlib
 import re
 import time
+import threading
+from .fetcher import set_rate_limit
+from . import fetcher
 
 class BadResponseException(Exception):
-    pass
+    # status is the HTTP status code of the response
+    def __init__(self,message,status=None):
+        Exception.__init__(self,message)
+        self.status = status
 
 def url_to_tag(url):
     return '_'.join(re.split('\W+',url))
 
-def get_soup(url,sleep=0,verbose=False):
-    tag = url_to_tag(url)
-
-    try:
-        response = relish.load(tag)
+class ResponseStore:
+    # HTTP responses kept in a sqlite table keyed by a hash of the url: status,
+    # headers, fetch time and the zlib-compressed body. Entries expire after a
+    # time that depends on their status (ttls, in seconds; statuses not listed
+    # there, like 429 or 5xx, are never stored), and the least recently used
+    # entries are evicted once the bodies add up to more than max_bytes.
+
+    def __init__(self,filename='./.http_cache/responses.sqlite',max_bytes=512*1024*1024,ttls=None):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        if ttls is None:
+            ttls = {200:30*24*3600,404:7*24*3600}
+        self.ttls = ttls
+        self.connection = None
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # opened on first use; shared by threads, so all access is under self.lock
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.filename),exist_ok=True)
+            self.connection = sqlite3.connect(self.filename,check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT, body BLOB, size INTEGER, fetched REAL, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size),0) FROM responses').fetchone()[0]
+        return self.connection
+
+    def key(self,url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get(self,url,max_age=None):
+        # returns a dictionary with status, headers, text and fetched, or None
+        # if the url isn't stored or its entry has expired; max_age (seconds)
+        # treats anything older as missing without removing it
+        key = self.key(url)
+        with self.lock:
+            con = self.connect()
+            row = con.execute('SELECT status,headers,body,size,fetched FROM responses WHERE key=?',(key,)).fetchone()
+            if row is None:
+                return None
+            status,headers,body,size,fetched = row
+            now = time.time()
+            with con:
+                if now-fetched>self.ttls.get(status,0):
+                    con.execute('DELETE FROM responses WHERE key=?',(key,))
+                    self.total_bytes-=size
+                    return None
+                if max_age is not None and now-fetched>max_age:
+                    return None
+                con.execute('UPDATE responses SET last_used=? WHERE key=?',(now,key))
+        return {'status':status,'headers':json.loads(headers),'fetched':fetched,
+                'text':zlib.decompress(body).decode('utf-8')}
+
+    def put(self,url,status,headers,text):
+        if self.ttls.get(status,0)<=0:
+            return
+        body = zlib.compress(text.encode('utf-8'))
+        now = time.time()
+        key = self.key(url)
+        with self.lock:
+            con = self.connect()
+            with con:
+                old = con.execute('SELECT size FROM responses WHERE key=?',(key,)).fetchone()
+                if old is not None:
+                    self.total_bytes-=old[0]
+                con.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?)',
+                            (key,url,status,json.dumps(dict(headers)),body,len(body),now,now))
+                self.total_bytes+=len(body)
+                while self.total_bytes>self.max_bytes:
+                    victim = con.execute('SELECT key,size FROM responses ORDER BY last_used LIMIT 1').fetchone()
+                    if victim is None:
+                        break
+                    con.execute('DELETE FROM responses WHERE key=?',(victim[0],))
+                    self.total_bytes-=victim[1]
+
+    def clear(self):
+        with self.lock:
+            con = self.connect()
+            with con:
+                con.execute('DELETE FROM responses')
+            self.total_bytes = 0
+
+response_store = ResponseStore()
+
+def get_page(url,sleep=0,verbose=False,max_age=None):
+    # Text of url, from response_store if it's there and fresh, otherwise fetched
+    # (after sleep seconds and the host's rate limit) and stored. Raises
+    # BadResponseException for anything but a 200, whether cached or not.
+    # max_age (seconds) refetches pages stored longer ago than that.
+    cached = response_store.get(url,max_age=max_age)
+    if cached is not None:
         if verbose:
-            print('Getting cached %s'%tag)
-    except Exception as e:
+            print('Getting cached %s'%url)
+        status = cached['status']
+        text = cached['text']
+    else:
         if sleep:
             if verbose:
                 print('Sleeping %0.3f seconds.'%sleep)
         time.sleep(sleep)
-        
-        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36"}
-        response = requests.get(url,headers=headers)
+        response = fetcher.get(url)
         if verbose:
             print('%s, status: %d'%(url,response.status_code))
-        relish.save(tag,response)
-        if not response.status_code==200:
-            raise BadResponseException
-
-    soup = BeautifulSoup(response.text, 'html.parser')
+        status = response.status_code
+        text = response.text
+        response_store.put(url,status,response.headers,text)
+    if not status==200:
+        raise BadResponseException('%s returned status %d'%(url,status),status)
+    return text
+
+def get_soup(url,sleep=0,verbose=False,parser='html.parser',parse_only=None,max_age=None):
+    # parser can be any BeautifulSoup parser ('lxml' is much faster, if installed);
+    # parse_only is an optional SoupStrainer limiting parsing to the tags needed
+    soup = BeautifulSoup(get_page(url,sleep=sleep,verbose=verbose,max_age=max_age), parser, parse_only=parse_only)
     return soup
 
 
 def get_pfr_id_from_google(fp_name,sleep_time=45):
+    # sleep_time is the minimum spacing of live Google queries, enforced by its
+    # rate limiter, so cached searches and concurrent callers don't sleep needlessly
     name_string = '+'.join(fp_name.split())
     google_url = 'https://www.google.com/search?q=%s+site:pro-football-reference.com'%name_string
 
@@ -49,8 +150,9 @@ def get_pfr_id_from_google(fp_name,sleep_time=45):
     # 45 sec between calls--maybe more, and once you get
     # a 429 response (too many calls), may have to wait hours
     # before trying again.
-    print('Googling %s, waiting %d s.'%(fp_name,sleep_time))
-    google_soup = get_soup(google_url,sleep=sleep_time,verbose=False)
+    print('Googling %s, at most one search every %d s.'%(fp_name,sleep_time))
+    set_rate_limit('www.google.com',sleep_time)
+    google_soup = get_soup(google_url,verbose=False)
     links = google_soup.find_all('a')
     pfr_id_google = ''
     for k in range(len(links)):
@@ -70,6 +172,8 @@ def get_pfr_id_from_google(fp_name,sleep_time=45):
 
 
 def foo():
+    import relish
+    from matplotlib import pyplot as plt
     table = soup.find('table')
 
     records = []
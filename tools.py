@@ -1,15 +1,13 @@
-import numpy as np
 import logging
-import relish
 import itertools
-import pandas as pd
-import sys
+import sys,os
+import time
+import json
+import sqlite3
+import hashlib
+import numbers
+from concurrent.futures import ProcessPoolExecutor
 
-try:
-    keeper_dictionary = relish.load('keeper_dictionary')
-except:
-    keeper_dictionary = {}
-    relish.save('keeper_dictionary',keeper_dictionary)
 
 def posrank_split(posrank):
     temp = posrank[::-1]
@@ -24,15 +22,256 @@ def posrank_split(posrank):
             rev_pos_string = rev_pos_string + temp[idx]
     return rev_pos_string[::-1],int(rev_rank_string[::-1])
 
+keeper_positions = ['QB','RB','WR','TE']
+keeper_limits = {'QB':3,'RB':3,'WR':3,'TE':2}
+
+def keepers_valid(counts,rookie_counts):
+    # counts and rookie_counts map position to number kept; these are the league's
+    # keeper rules: up to 2 QBs, 5 RB/WRs and 1 TE, with one extra allowed at each
+    # if it's covered by a rookie at that position, but never more than 3 RBs or 3 WRs.
+    # The values may be ints or arrays of counts, in which case a boolean mask is returned.
+    n_flex = counts['RB']+counts['WR']
+    n_flex_rookies = rookie_counts['RB']+rookie_counts['WR']
+    qb_ok = (counts['QB']<3) | ((counts['QB']==3) & (rookie_counts['QB']>0))
+    rb_wr_ok = (counts['RB']<=3) & (counts['WR']<=3)
+    flex_ok = (n_flex<6) | ((n_flex==6) & (n_flex_rookies>0))
+    te_ok = (counts['TE']<2) | ((counts['TE']==2) & (rookie_counts['TE']>0))
+    return qb_ok & rb_wr_ok & flex_ok & te_ok
+
+def search_keepers(players,rookie_year,n_keepers=9):
+    # Exact replacement for scoring every itertools.combinations(players,n_keepers).
+    # Once the number kept at each position is fixed, the best choice at a position is its
+    # best-ranked players, swapping the worst of them for the best rookie left when
+    # keepers_valid needs a rookie there (3rd QB, 2nd TE, 6th RB/WR). So the best total rank
+    # is the minimum over the few ways to split n_keepers across positions. To break ties
+    # the way the full enumeration did (the first set in combination order wins), players
+    # are then taken in index order whenever a best-total set that includes them remains.
+    # Returns a tuple of indices into players, or None if no valid set exists.
+    inf = float('inf')
+    n = len(players)
+    ranks = [p.rank for p in players]
+    rookies = [p.draft_year==rookie_year for p in players]
+    by_position = dict([(pos,[]) for pos in keeper_positions])
+    for i in sorted(range(n),key=lambda i: (ranks[i],i)):
+        if players[i].position in by_position:
+            by_position[players[i].position].append(i)
+    splits = [split for split in itertools.product(*[range(keeper_limits[pos]+1) for pos in keeper_positions])
+              if sum(split)==n_keepers]
+
+    def best_at(pos,count,need_rookie,chosen,excluded):
+        # lowest total rank of count players at pos that include everyone chosen there
+        forced = [i for i in by_position[pos] if i in chosen]
+        pool = [i for i in by_position[pos] if i not in chosen and i not in excluded]
+        m = count-len(forced)
+        if m<0 or m>len(pool):
+            return inf
+        picks = forced+pool[:m]
+        if need_rookie and not any([rookies[i] for i in picks]):
+            later = [i for i in pool[m:] if rookies[i]]
+            if m==0 or len(later)==0:
+                return inf
+            picks = forced+pool[:m-1]+later[:1]
+        return sum([ranks[i] for i in picks])
+
+    def best_total(chosen,excluded):
+        memo = {}
+        def at(pos,count,need_rookie):
+            if (pos,count,need_rookie) not in memo:
+                memo[(pos,count,need_rookie)] = best_at(pos,count,need_rookie,chosen,excluded)
+            return memo[(pos,count,need_rookie)]
+        best = inf
+        for split in splits:
+            c = dict(zip(keeper_positions,split))
+            total = at('QB',c['QB'],c['QB']==3)+at('TE',c['TE'],c['TE']==2)
+            if c['RB']+c['WR']==6:
+                total = total+min(at('RB',c['RB'],True)+at('WR',c['WR'],False),
+                                  at('RB',c['RB'],False)+at('WR',c['WR'],True))
+            else:
+                total = total+at('RB',c['RB'],False)+at('WR',c['WR'],False)
+            best = min(best,total)
+        return best
+
+    target = best_total(set(),set())
+    if target==inf:
+        return None
+    tolerance = 1e-9*max(1.0,abs(target))
+    chosen = set()
+    excluded = set()
+    for i in range(n):
+        if len(chosen)==n_keepers:
+            break
+        chosen.add(i)
+        if best_total(chosen,excluded)>target+tolerance:
+            chosen.remove(i)
+            excluded.add(i)
+    return tuple(sorted(chosen))
+
+def players_to_keeper_arrays(players,rookie_year):
+    # compact arrays describing players: rank, index into keeper_positions, and rookie flag
+    import numpy as np
+    ranks = np.array([p.rank for p in players],dtype=np.float64)
+    codes = np.array([keeper_positions.index(p.position) for p in players],dtype=np.int8)
+    rookies = np.array([p.draft_year==rookie_year for p in players],dtype=bool)
+    return ranks,codes,rookies
+
+def combination_blocks(n,k,chunk_size=65536):
+    # yield itertools.combinations(range(n),k) as (m,k) index matrices of at most chunk_size rows
+    import numpy as np
+    combs = itertools.combinations(range(n),k)
+    while True:
+        block = np.fromiter(itertools.chain.from_iterable(itertools.islice(combs,chunk_size)),dtype=np.int16)
+        if len(block)==0:
+            break
+        yield block.reshape(-1,k)
+
+def score_keeper_block(block,ranks,codes,rookies):
+    # validity mask and mean rank for every row of a combination index matrix
+    block_codes = codes[block]
+    block_rookies = rookies[block]
+    counts = {}
+    rookie_counts = {}
+    for code,pos in enumerate(keeper_positions):
+        at_pos = block_codes==code
+        counts[pos] = at_pos.sum(axis=1)
+        rookie_counts[pos] = (at_pos & block_rookies).sum(axis=1)
+    valid = keepers_valid(counts,rookie_counts)
+    scores = ranks[block].mean(axis=1)
+    return valid,scores
+
+def exhaustive_keepers(players,rookie_year,n_keepers=9,chunk_size=65536):
+    # Batched version of the original full enumeration: every combination is scored,
+    # a block at a time. Too slow to use routinely on deep rosters, but useful as a
+    # reference to check search_keepers against. Same return value as search_keepers.
+    import numpy as np
+    ranks,codes,rookies = players_to_keeper_arrays(players,rookie_year)
+    best_score = np.inf
+    best = None
+    for block in combination_blocks(len(players),n_keepers,chunk_size):
+        valid,scores = score_keeper_block(block,ranks,codes,rookies)
+        if not valid.any():
+            continue
+        scores[~valid] = np.inf
+        winner = np.argmin(scores)
+        if scores[winner]<best_score:
+            best_score = scores[winner]
+            best = tuple(int(i) for i in block[winner])
+    return best
+
+def solve_keepers(players,rookie_year,exhaustive=False):
+    # top-level so it can be shipped to worker processes by League.compute_keepers
+    if exhaustive:
+        return exhaustive_keepers(players,rookie_year)
+    return search_keepers(players,rookie_year)
+
+# bump this whenever keepers_valid, keeper_limits or the scoring change, so that
+# keepers cached under the old rules are not served
+keeper_rules_version = 2
+
+class KeeperCache:
+    # Keepers solved for a given roster and rookie year, kept in a small sqlite
+    # table. Only new results are written, and the least recently used rows are
+    # evicted once there are more than max_entries of them.
+
+    def __init__(self,filename='./.keeper_cache/keepers.sqlite',max_entries=5000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.connection = None
+
+    def connect(self):
+        # opened on first use rather than at import
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.filename),exist_ok=True)
+            self.connection = sqlite3.connect(self.filename)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS keepers (key TEXT PRIMARY KEY, unique_ids TEXT, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS keepers_last_used ON keepers (last_used)')
+        return self.connection
+
+    def key(self,players,rookie_year):
+        ids = '-'.join(sorted([p.unique_id for p in players]))
+        raw = '%s|%s|%d'%(ids,rookie_year,keeper_rules_version)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+    def get(self,key):
+        con = self.connect()
+        row = con.execute('SELECT unique_ids FROM keepers WHERE key=?',(key,)).fetchone()
+        if row is None:
+            return None
+        with con:
+            con.execute('UPDATE keepers SET last_used=? WHERE key=?',(time.time(),key))
+        return json.loads(row[0])
+
+    def put_many(self,items):
+        # items is a list of (key,unique_ids) pairs
+        con = self.connect()
+        now = time.time()
+        with con:
+            con.executemany('INSERT OR REPLACE INTO keepers VALUES (?,?,?)',
+                            [(key,json.dumps(unique_ids),now) for key,unique_ids in items])
+            con.execute('DELETE FROM keepers WHERE key IN (SELECT key FROM keepers ORDER BY last_used DESC LIMIT -1 OFFSET ?)',(self.max_entries,))
+
+    def put(self,key,unique_ids):
+        self.put_many([(key,unique_ids)])
+
+    def clear(self):
+        con = self.connect()
+        with con:
+            con.execute('DELETE FROM keepers')
+
+keeper_cache = KeeperCache()
+
 class League:
     
     def __init__(self):
         self.teams = []
 
-    def get_all_keepers(self):
+    def get_all_keepers(self,rookie_year,workers=1):
+        keepers = self.compute_keepers(rookie_year,workers=workers)
         out = []
         for t in self.teams:
-            out = out + t.get_keepers()
+            out = out + keepers[t]
+        return out
+
+    def compute_keepers(self,rookie_year,workers=None,exhaustive=False):
+        # Returns a dictionary mapping each Team to its keepers (as returned by
+        # Team.get_keepers, or an empty list if the team has no valid set). Teams
+        # missing from the keeper cache are solved in a pool of worker processes;
+        # workers=None uses one per CPU. exhaustive=True neither reads nor writes
+        # the cache, so its answers can be checked against search_keepers'.
+        out = {}
+        todo = []
+        for t in self.teams:
+            players = t.keeper_pool()
+            if exhaustive:
+                unique_ids = None
+            else:
+                unique_ids = keeper_cache.get(keeper_cache.key(players,rookie_year))
+            if unique_ids is None:
+                todo.append(t)
+            else:
+                out[t] = t.sort_by_position([p for p in players if p.unique_id in unique_ids])
+
+        if len(todo)==0:
+            return out
+
+        pools = [t.keeper_pool() for t in todo]
+        if workers==1 or len(todo)==1:
+            results = [solve_keepers(players,rookie_year,exhaustive) for players in pools]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(solve_keepers,pools,[rookie_year]*len(todo),[exhaustive]*len(todo)))
+
+        new_items = []
+        for t,players,idx in zip(todo,pools,results):
+            if idx is None:
+                # not cached, so it's solved again once the roster changes
+                logging.warning('No valid set of keepers for %s; it keeps no one.'%t.team_name)
+                out[t] = []
+                continue
+            keepers = t.keepers_from_indices(players,idx)
+            new_items.append((keeper_cache.key(players,rookie_year),[p.unique_id for p in keepers]))
+            out[t] = t.sort_by_position(keepers)
+        if not exhaustive:
+            keeper_cache.put_many(new_items)
         return out
 
     def __len__(self):
@@ -60,19 +299,132 @@ def row_to_player(row):
     p.draft_pick = row['draft_pick']
     p.pfr_id = row['pfr_id']
     p.posrank = row['POS']
-    p.positional_rank = posrank_split(p.posrank)[1]
+    p.positional_rank = positional_rank
     return p
     
 def players_df_to_players(player_df):
-    players = []
-    for idx,row in player_df.iterrows():
-        player = row_to_player(row)
-        players.append(player)
-    return players
-        
-        
+    return list(PlayerTable(player_df))
+
+def int_column(values):
+    # values as an int64 array, with anything that isn't a number as 0
+    import numpy as np
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        return values.astype(np.int64)
+    if values.dtype.kind=='f':
+        return np.nan_to_num(values,nan=0.0,posinf=0.0,neginf=0.0).astype(np.int64)
+    out = np.zeros(len(values),dtype=np.int64)
+    for k,v in enumerate(values):
+        try:
+            out[k] = int(v)
+        except (TypeError,ValueError):
+            pass
+    return out
+
+def text_column(values,missing=''):
+    # values as an object array of str, with NaN and None as missing
+    import numpy as np
+    return np.array([v if type(v)==str else missing for v in values],dtype=object)
+
+def split_posranks(posranks):
+    # vectorized posrank_split: arrays of positions and positional ranks
+    # (0 where there's no rank)
+    import numpy as np
+    names = {}
+    positions = np.array([names.setdefault(p,p) for p in [s.rstrip('0123456789') for s in posranks]],dtype=object)
+    ranks = np.array([int(s[len(p):]) if len(s)>len(p) else 0 for s,p in zip(posranks,positions)],dtype=np.int64)
+    return positions,ranks
+
+def make_unique_id(name,position,team):
+    # the id used by Player.unique_id, e.g. 'mikeevans-wr-tb'
+    def cleanup(s):
+        for item in [' ','-',"'",',','.']:
+            s = s.replace(item,'')
+        return s
+    return '-'.join([cleanup(item.lower().strip()) for item in [name,position,team]])
+
+class PlayerTable:
+    # A player table (as read from player_table.csv) held as one typed NumPy array
+    # per Player attribute rather than one Player object per row. Players are made
+    # on demand: table[k] and iteration give Players, table[mask] or
+    # table[list of rows] give a smaller PlayerTable, and the arrays can be used
+    # directly, e.g. table.rank[table.position=='WR'].
+
+    columns = ('name','position','team','rank','tier','draft_year','draft_round','draft_pick',
+               'pfr_id','posrank','positional_rank','unique_id')
+
+    def __init__(self,player_df=None):
+        import numpy as np
+        self.row_positions = None
+        if player_df is None:
+            for col in self.columns:
+                setattr(self,col,np.zeros(0,dtype=object))
+            return
+        self.name = text_column(player_df['PLAYER NAME'])
+        self.team = text_column(player_df['TEAM'])
+        self.posrank = text_column(player_df['POS'])
+        self.position,self.positional_rank = split_posranks(self.posrank)
+        self.rank = int_column(player_df['RK'])
+        if 'TIERS' in player_df.columns:
+            self.tier = int_column(player_df['TIERS'])
+        else:
+            self.tier = np.zeros(len(self.name),dtype=np.int64)
+        self.draft_year = int_column(player_df['draft_year'])
+        self.draft_round = int_column(player_df['draft_round'])
+        self.draft_pick = int_column(player_df['draft_pick'])
+        self.pfr_id = text_column(player_df['pfr_id'])
+        self.unique_id = np.array([make_unique_id(n,p,t) for n,p,t in zip(self.name,self.position,self.team)],dtype=object)
+
+    def __len__(self):
+        return len(self.name)
+
+    def __iter__(self):
+        columns = [getattr(self,col).tolist() for col in self.columns]
+        for values in zip(*columns):
+            p = Player.__new__(Player)
+            for col,value in zip(self.columns,values):
+                setattr(p,col,value)
+            yield p
+
+    def __getitem__(self,rows):
+        if isinstance(rows,numbers.Integral):
+            return self.player(rows)
+        return self.take(rows)
+
+    def take(self,rows):
+        # a PlayerTable of the given rows (an index array, boolean mask or slice)
+        out = PlayerTable()
+        for col in self.columns:
+            setattr(out,col,getattr(self,col)[rows])
+        return out
+
+    def player(self,k,name=None,position=None,team=None):
+        # Player for row k; name, position and team override the table's (e.g.
+        # with the ones ESPN uses), as in Player(name,position,team,data_row)
+        p = Player.__new__(Player)
+        for col in self.columns:
+            setattr(p,col,getattr(self,col).item(k))
+        if not (name is None and position is None and team is None):
+            if name is not None:
+                p.name = name
+            if position is not None:
+                p.position = position
+            if team is not None:
+                p.team = team
+            p.unique_id = p.get_unique_id()
+        return p
+
+    def find(self,unique_id):
+        # row of the player with Player.unique_id unique_id, or -1
+        if self.row_positions is None:
+            self.row_positions = dict(zip(self.unique_id.tolist(),range(len(self))))
+        return self.row_positions.get(unique_id,-1)
+
 class Player:
-    
+    # __slots__ keep Players small; a PlayerTable makes them from its arrays
+    __slots__ = ('name','position','team','rank','tier','draft_year','draft_round','draft_pick',
+                 'pfr_id','posrank','positional_rank','unique_id')
+
     def __init__(self,name,position,team,data_row=None):
         self.name = name
         self.position = position
@@ -85,20 +437,24 @@ class Player:
             self.draft_pick = 0
             self.pfr_id = ''
             self.posrank = ''
+            self.positional_rank = 0
             
         else:
             # Unnamed: 0  RK  TIERS PLAYER NAME TEAM   POS  BEST  WORST  AVG.  STD.DEV    pfr_id  draft_year  draft_round  draft_pick      unique_id
             # 35          35  36      5  Mike Evans   TB  WR15    25     49  36.6      4.9  EvanMi00        2014            1           7  mikeevanswrtb
-            self.rank = data_row['RK'].values[0]
+            # data_row is a one row DataFrame or a Series
+            if getattr(data_row,'ndim',1)==2:
+                data_row = data_row.iloc[0]
+            self.rank = data_row['RK']
             try:
-                self.tier = data_row['TIERS'].values[0]
-            except:
+                self.tier = data_row['TIERS']
+            except KeyError:
                 self.tier = 0
-            self.draft_year = data_row['draft_year'].values[0]
-            self.draft_round = data_row['draft_round'].values[0]
-            self.draft_pick = data_row['draft_pick'].values[0]
-            self.pfr_id = data_row['pfr_id'].values[0]
-            self.posrank = data_row['POS'].values[0]
+            self.draft_year = data_row['draft_year']
+            self.draft_round = data_row['draft_round']
+            self.draft_pick = data_row['draft_pick']
+            self.pfr_id = data_row['pfr_id']
+            self.posrank = data_row['POS']
             self.positional_rank = posrank_split(self.posrank)[1]
 
         # do some checks:
@@ -110,13 +466,16 @@ class Player:
         self.unique_id = self.get_unique_id()
             
     def get_unique_id(self):
-        
-        def cleanup(s):
-            for item in [' ','-',"'",',','.']:
-                s = s.replace(item,'')
-            return s
-        
-        return '-'.join([cleanup(item.lower().strip()) for item in [self.name,self.position,self.team]])
+        return make_unique_id(self.name,self.position,self.team)
+
+    def __getstate__(self):
+        return dict([(k,getattr(self,k)) for k in self.__slots__ if hasattr(self,k)])
+
+    def __setstate__(self,state):
+        # also loads Players pickled before __slots__, whose state is their __dict__
+        for k,v in state.items():
+            if k in self.__slots__:
+                setattr(self,k,v)
             
     def __lt__(self,other):
         return self.rank<other.rank
@@ -142,7 +501,7 @@ class Team:
 
 
     def __lt__(self,other):
-        return np.sum([p.rank for p in sorted(self.players)[:9]])<np.sum([p.rank for p in sorted(other.players)[:9]])
+        return sum([p.rank for p in sorted(self.players)[:9]])<sum([p.rank for p in sorted(other.players)[:9]])
 
     def __len__(self):
         return len(self.players)
@@ -221,62 +580,36 @@ class Team:
     def has_rookie(self,plist,rookie_year):
         return any([p.draft_year==rookie_year for p in plist])
                 
-    def get_keepers(self,rookie_year,verbose=False):
-        players = [p for p in self.players if p.position in ['QB','RB','WR','TE']]
-        key = '-'.join(sorted([p.unique_id for p in players]))
-        try:
-            unique_ids = keeper_dictionary[key]
+    def keeper_pool(self):
+        return [p for p in self.players if p.position in keeper_positions]
+
+    def keepers_from_indices(self,players,idx):
+        # idx is the solver's choice of indices into players
+        if idx is None:
+            raise ValueError('No valid set of keepers for %s.'%self.team_name)
+        return [players[i] for i in idx]
+
+    def get_keepers(self,rookie_year,verbose=False,exhaustive=False):
+        # exhaustive=True scores every combination with exhaustive_keepers instead of
+        # running search_keepers; the answer should be the same. It bypasses the
+        # keeper cache, which only holds search_keepers' answers.
+        players = self.keeper_pool()
+        key = keeper_cache.key(players,rookie_year)
+        if exhaustive:
+            unique_ids = None
+        else:
+            unique_ids = keeper_cache.get(key)
+        if unique_ids is None:
+            idx = solve_keepers(players,rookie_year,exhaustive)
+            if idx is None:
+                # as in League.compute_keepers: not cached, and the team keeps no one
+                logging.warning('No valid set of keepers for %s; it keeps no one.'%self.team_name)
+                return []
+            out = self.keepers_from_indices(players,idx)
+            if not exhaustive:
+                keeper_cache.put(key,[p.unique_id for p in out])
+        else:
             out = [p for p in players if p.unique_id in unique_ids]
-        except KeyError as e:
-            perms = itertools.combinations(players,9)
-            candidates = []
-
-            def npos(pos,player_list):
-                return len(self.get_corps(pos,player_list=player_list))
-
-            def has_rookie(plist,pos=None):
-                if pos is None:
-                    return any([p.draft_year==rookie_year for p in plist])
-                else:
-                    return any([p.draft_year==rookie_year for p in plist if p.position in pos])
-
-            def valid(k):
-                positions = ['QB','RB','WR','TE']
-                try:
-
-                    assert npos('QB',k)<3 or (npos('QB',k)==3 and has_rookie(k,['QB']))
-
-                    assert npos('RB',k)<=3
 
-                    assert npos('WR',k)<=3
-
-                    assert (npos('RB',k)+npos('WR',k)<6) or (npos('RB',k)+npos('WR',k)==6 and (has_rookie(k,['RB','WR'])))
-
-                    assert (npos('TE',k)<2) or (npos('TE',k)==2 and has_rookie(k,['TE']))
-                except AssertionError:
-                    return False
-                return True
-
-
-            def score(k):
-                return np.mean([p.rank for p in k])
-
-
-            candidates = []
-            scores = []
-
-            for perm in perms:
-                perm = list(perm)
-                out = [p for p in perm if p.position=='QB']+[p for p in perm if p.position=='RB']+[p for p in perm if p.position=='WR']+[p for p in perm if p.position=='TE']
-                if valid(out):
-                    candidates.append(out)
-                    scores.append(score(out))
-
-            minscore = np.argmin(scores)
-            out = candidates[minscore]
-            keeper_dictionary[key] = [p.unique_id for p in out]
-
-            relish.save('keeper_dictionary',keeper_dictionary)
-            
         out = self.sort_by_position(out)
         return out